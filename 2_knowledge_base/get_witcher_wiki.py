@@ -1,10 +1,82 @@
+import os
+import json
 import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+KB_DIR = os.path.join(SCRIPT_DIR, "knowledge_base")
+# Чекпоинт: ревизия каждой уже сохранённой страницы. Прерванный запуск продолжается
+# с места остановки, а страницы без новых правок не скачиваются повторно.
+STATE_PATH = os.path.join(SCRIPT_DIR, ".crawl_state.json")
+
+# Адрес API можно подменить (например, на локальный stub-сервер для проверки)
+API_URL = os.getenv("WIKI_API_URL", "https://vedmak.fandom.com/api.php")
+CATEGORY = "Категория:Персонажи_(Ведьмак_3)"
+
+WORKERS = int(os.getenv("WIKI_WORKERS", "8"))
+RATE_LIMIT = float(os.getenv("WIKI_RATE_LIMIT", "10"))  # запросов в секунду на все потоки вместе
+BATCH_SIZE = 50  # максимум titles в одном запросе для обычного (не бот) аккаунта
+
+# Страницы с ошибками не пишутся в базу знаний, а уходят в очередь повторов
+MAX_RETRIES = 3
+RETRY_DELAY = 2.0
+ERROR_PREFIXES = ("Ошибка: ", "Произошла ошибка: ")
+
+
+class RateLimiter:
+   """Global limit on request rate shared by all worker threads."""
+
+   def __init__(self, rate):
+      self.interval = 1.0 / rate if rate > 0 else 0.0
+      self._next = 0.0
+      self._lock = threading.Lock()
+
+   def wait(self):
+      with self._lock:
+         now = time.monotonic()
+         slot = max(now, self._next)
+         self._next = slot + self.interval
+      if slot > now:
+         time.sleep(slot - now)
+
+
+def make_session(pool_size):
+   """HTTP session with a connection pool sized for the workers and retries on 429/5xx."""
+   session = requests.Session()
+   retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+   adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+   session.mount("http://", adapter)
+   session.mount("https://", adapter)
+   return session
+
+
+session = make_session(WORKERS)
+limiter = RateLimiter(RATE_LIMIT)
+
+
+def api_get(params):
+   limiter.wait()
+   response = session.get(API_URL, params=params, timeout=30)
+   response.raise_for_status()
+   return response.json()
+
+
+def html_to_text(html_content):
+   soup = BeautifulSoup(html_content, 'html.parser')
+   # rvparse, в отличие от action=parse, не умеет disableeditsection — убираем ссылки [править] сами
+   for link in soup.select(".mw-editsection"):
+      link.decompose()
+   return soup.get_text(separator=' ', strip=True)
+
+
 def parse_to_markdown(page_name):
-   url = "https://vedmak.fandom.com/api.php"
-   
    # Параметры API:
    # prop=text - получаем само содержимое
    # redirects=1 - если ввели "Геральт", перекинет на "Геральт из Ривии"
@@ -20,9 +92,7 @@ def parse_to_markdown(page_name):
    }
 
    try:
-      response = requests.get(url, params=params)
-      response.raise_for_status()
-      data = response.json()
+      data = api_get(params)
 
       if "error" in data:
          return f"Ошибка: {data['error']['info']}"
@@ -30,54 +100,206 @@ def parse_to_markdown(page_name):
       # Получаем HTML контент
       html_content = data["parse"]["text"]["*"]
 
-      soup = BeautifulSoup(html_content, 'html.parser')
-      result = soup.get_text(separator=' ', strip=True)
-
-      return result
+      return html_to_text(html_content)
 
    except Exception as e:
       return f"Произошла ошибка: {e}"
 
-def get_all_characters():
-    
-   URL = "https://vedmak.fandom.com/api.php"
-   
-   PARAMS = {
+def get_character_revisions():
+   """Titles of all character pages with their last revision id and touch timestamp."""
+   params = {
       "action": "query",
-      "list": "categorymembers",
-      "cmtitle": "Категория:Персонажи_(Ведьмак_3)",
-      "cmlimit": "max",
+      "generator": "categorymembers",
+      "gcmtitle": CATEGORY,
+      "gcmlimit": "max",
+      "prop": "info",
       "format": "json"
    }
 
-   all_characters = []
-   
+   revisions = {}
+
    while True:
-      r = requests.get(url=URL, params=PARAMS)
-      data = r.json()
+      data = api_get(params)
 
-      # Собираем названия страниц
-      pages = data.get("query", {}).get("categorymembers", [])
-      for page in pages:
-         all_characters.append(page["title"])
+      # prop=info сразу отдаёт lastrevid/touched, отдельный запрос на страницу не нужен
+      pages = data.get("query", {}).get("pages", {})
+      for page in pages.values():
+         revisions[page["title"]] = {"revid": page.get("lastrevid"), "touched": page.get("touched")}
 
       # Если персонажей больше 500, API вернет 'continue'
       if "continue" in data:
-         PARAMS.update(data["continue"])
+         params.update(data["continue"])
       else:
          break
 
-   return all_characters
+   return revisions
+
+def get_all_characters():
+   return list(get_character_revisions())
+
+
+def load_state():
+   if os.path.exists(STATE_PATH):
+      with open(STATE_PATH, "r", encoding="utf-8") as f:
+         return json.load(f)
+   return {}
+
+def save_state(state):
+   tmp_path = STATE_PATH + ".tmp"
+   with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump(state, f, ensure_ascii=False, indent=2)
+   os.replace(tmp_path, STATE_PATH)
+
+
+def page_path(title):
+   return os.path.join(KB_DIR, f"{title}.md")
+
+def is_error_text(text):
+   return text.startswith(ERROR_PREFIXES)
+
+def save_page(title, text):
+   # Сохраняем для RAG
+   with open(page_path(title), "w", encoding="utf-8") as f:
+      f.write(text)
+
+
+def fetch_batch(titles):
+   """Fetch rendered text and revision metadata for up to BATCH_SIZE pages in one query.
+
+   The server renders the pages (rvparse), so the text is the same as
+   action=parse gives for a single page. A page that comes back without
+   rendered HTML (the server may parse only part of a batch) falls back to
+   action=parse. Returns (pages, errors): pages maps the requested title to
+   {"text", "revid", "timestamp"}, errors maps it to an error message.
+   """
+   params = {
+      "action": "query",
+      "prop": "revisions",
+      "titles": "|".join(titles),
+      "rvprop": "ids|timestamp|content",
+      "rvslots": "main",
+      "rvparse": 1,
+      "redirects": 1,
+      "format": "json",
+      "formatversion": 2
+   }
+
+   found = {}
+   aliases = {}
+   try:
+      while True:
+         data = api_get(params)
+         if "error" in data:
+            return {}, {title: f"Ошибка: {data['error']['info']}" for title in titles}
+
+         query = data.get("query", {})
+         # Нормализация и редиректы: запрошенное имя -> фактический заголовок страницы
+         for item in query.get("normalized", []) + query.get("redirects", []):
+            aliases[item["from"]] = item["to"]
+         for page in query.get("pages", []):
+            entry = found.setdefault(page["title"], {})
+            if page.get("missing") or page.get("invalid"):
+               entry["missing"] = True
+            if page.get("revisions"):
+               revision = page["revisions"][0]
+               entry["revid"] = revision.get("revid")
+               entry["timestamp"] = revision.get("timestamp")
+               content = revision.get("slots", {}).get("main", {}).get("content") or revision.get("content")
+               # Отрендеренный текст всегда обёрнут в mw-parser-output; иначе это исходная разметка
+               if content and "mw-parser-output" in content:
+                  entry["html"] = content
+
+         # Если суммарный объём текстов велик, API отдаёт их порциями: дочитываем по continue
+         if "continue" in data:
+            params.update(data["continue"])
+         else:
+            break
+   except Exception as e:
+      return {}, {title: f"Произошла ошибка: {e}" for title in titles}
+
+   pages = {}
+   errors = {}
+   for title in titles:
+      resolved = title
+      for _ in range(3):
+         resolved = aliases.get(resolved, resolved)
+      entry = found.get(resolved, {})
+      if entry.get("missing"):
+         errors[title] = "Ошибка: страница не найдена"
+         continue
+      if "html" in entry:
+         text = html_to_text(entry["html"])
+      else:
+         text = parse_to_markdown(title)
+         if is_error_text(text):
+            errors[title] = text
+            continue
+      if not text:
+         errors[title] = "Ошибка: пустой текст страницы"
+         continue
+      pages[title] = {"text": text, "revid": entry.get("revid"), "timestamp": entry.get("timestamp")}
+   return pages, errors
+
+
+def crawl(workers=WORKERS, full=False):
+   """Download changed character pages in parallel batches. Returns (saved, skipped, failed)."""
+   revisions = get_character_revisions()
+   state = {} if full else load_state()
+
+   todo = [
+      title for title, info in revisions.items()
+      if state.get(title, {}).get("revid") != info["revid"] or not os.path.exists(page_path(title))
+   ]
+   skipped = len(revisions) - len(todo)
+   print(f"Страниц в категории: {len(revisions)}, без изменений: {skipped}, к загрузке: {len(todo)}")
+
+   saved = 0
+   errors = {}
+   executor = ThreadPoolExecutor(max_workers=workers)
+   try:
+      for attempt in range(MAX_RETRIES + 1):
+         if attempt:
+            # Очередь повторов: страницы с ошибками не пишутся в базу знаний, а запрашиваются снова
+            todo = list(errors)
+            if not todo:
+               break
+            print(f"Повтор {attempt}/{MAX_RETRIES} для {len(todo)} страниц")
+            time.sleep(RETRY_DELAY * attempt)
+            errors = {}
+
+         batches = [todo[i:i + BATCH_SIZE] for i in range(0, len(todo), BATCH_SIZE)]
+         futures = [executor.submit(fetch_batch, batch) for batch in batches]
+         for future in as_completed(futures):
+            pages, batch_errors = future.result()
+            errors.update(batch_errors)
+            for title, page in pages.items():
+               save_page(title, page["text"])
+               state[title] = {"revid": page["revid"] or revisions[title]["revid"], "touched": revisions[title]["touched"]}
+               saved += 1
+               print(f"Готово! Страница '{title}' сохранена в формате Markdown.")
+               # Чекпоинт после каждой страницы: прерванный запуск не скачает её снова
+               save_state(state)
+   finally:
+      # При Ctrl-C не ждём оставшиеся страницы: всё сохранённое уже в чекпоинте
+      executor.shutdown(wait=True, cancel_futures=True)
+      save_state(state)
+
+   for title, message in errors.items():
+      print(f"Не удалось получить страницу '{title}': {message}")
+   return saved, skipped, len(errors)
+
 
 # Пример использования
 if __name__ == "__main__":
+   parser = argparse.ArgumentParser(description="Загрузка страниц персонажей с Ведьмак-вики")
+   parser.add_argument("--workers", type=int, default=WORKERS, help="число параллельных загрузок")
+   parser.add_argument("--full", action="store_true", help="игнорировать чекпоинт и скачать всё заново")
+   args = parser.parse_args()
 
-   characters = get_all_characters()
-   for character in characters:
-      md_data = parse_to_markdown(character)
-      
-      # Сохраняем для RAG
-      with open(f"knowledge_base/{character}.md", "w", encoding="utf-8") as f:
-         f.write(md_data)
-      time.sleep(.1)
-      print(f"Готово! Страница '{character}' сохранена в формате Markdown.")
+   os.makedirs(KB_DIR, exist_ok=True)
+   start = time.perf_counter()
+   saved, skipped, failed = crawl(workers=args.workers, full=args.full)
+   print(
+      f"Сохранено: {saved}, пропущено без изменений: {skipped}, ошибок: {failed}. "
+      f"Время: {time.perf_counter() - start:.1f} сек"
+   )
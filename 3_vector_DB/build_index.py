@@ -1,50 +1,206 @@
 import os
-from chromadb.utils import embedding_functions
+import sys
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import chromadb
 from chonkie import SentenceChunker
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rag_common.chunking import chunk_hash, content_chunk_ids
+from rag_common.embedding_cache import EmbeddingCache
+from rag_common.index_swap import activate_collection, new_collection_name, smoke_check
+from rag_common.lazy import StartupReport
+from rag_common.lexical import BM25Index, drop_lexical_indexes, lexical_index_path
+from rag_common.models import load_embedding_function, load_reranker, model_cache_key
+from rag_common.retrieval import bump_index_version
+from rag_common.scoring import injection_fingerprint, injection_metadata, injection_scores, write_injection_fingerprint
+
 
 # EMBED_MODEL = "E:/models/paraphrase-multilingual-MiniLM-L12-v2"
 EMBED_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBED_MODEL)
 
-# 2. Инициализируем чанкер правильно (под токены)
-chunker = SentenceChunker(
-    tokenizer="character",
-    chunk_size=300,   
-    chunk_overlap=50
-)
+# Cross-encoder нужен только для предрасчёта опасности чанков (зонды инъекций)
+# RERANK_MODEL = "E:/models/mxbai-rerank-base-v1"
+RERANK_MODEL = "mixedbread-ai/mxbai-rerank-base-v1"
+INJECTION_FINGERPRINT = injection_fingerprint(model_cache_key(RERANK_MODEL))
 
-chroma_client = chromadb.PersistentClient(path="./my_vector_db")
-collection = chroma_client.get_or_create_collection(name="kb_v1", embedding_function=emb_fn)
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 50
 
+# Конвейер: процессы читают и чанкуют файлы -> эмбеддинги считаются большими батчами
+# -> отдельный поток пишет готовые векторы в Chroma
+READ_WORKERS = int(os.getenv("READ_WORKERS", str(os.cpu_count() or 2)))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "256"))
 
-def process_and_upload(directory):
-   total_chunks = 0
-   for filename in os.listdir(directory):
-      if not filename.endswith(".md"):
+chunker = None
+
+
+def init_chunker():
+   # Чанкер создаётся в каждом процессе-читателе отдельно
+   global chunker
+   # 2. Инициализируем чанкер правильно (под токены)
+   chunker = SentenceChunker(
+      tokenizer="character",
+      chunk_size=CHUNK_SIZE,
+      chunk_overlap=CHUNK_OVERLAP
+   )
+
+
+def read_and_chunk(path):
+   start = time.perf_counter()
+   with open(path, 'r', encoding='utf-8') as f:
+      text = f.read()
+   docs = [c.text for c in chunker.chunk(text)]
+   return os.path.basename(path), docs, time.perf_counter() - start
+
+
+class StageStats:
+   def __init__(self, name):
+      self.name = name
+      self.chunks = 0
+      self.seconds = 0.0
+
+   def report(self):
+      rate = self.chunks / self.seconds if self.seconds else 0.0
+      return f"{self.name:<12} {self.chunks:>6} чанков за {self.seconds:7.2f} сек ({rate:8.1f} чанков/сек)"
+
+
+def writer_loop(collection, batches, stats, errors):
+   while True:
+      batch = batches.get()
+      if batch is None:
+         return
+      if errors:
+         # После ошибки записи только вычитываем очередь, чтобы не заблокировать эмбеддинг
+         continue
+      start = time.perf_counter()
+      try:
+         collection.add(**batch)
+      except Exception as e:
+         errors.append(e)
          continue
-         
-      path = os.path.join(directory, filename)
-      with open(path, 'r', encoding='utf-8') as f:
-         text = f.read()
-         
-      chunks = chunker.chunk(text)
-      
-      # Готовим батч для одного файла
-      ids = [f"{filename}_{i}" for i in range(len(chunks))]
-      docs = [c.text for c in chunks]
-      metas = [{"source": filename, "chunk_id": i} for i in range(len(chunks))]
-      
-      # Добавляем в базу (тут можно добавить проверку на пустой docs)
-      if docs:
-         collection.add(documents=docs, metadatas=metas, ids=ids)
-         print(f"Indexed: {filename} ({len(docs)} chunks)")
-         total_chunks += len(docs)
-   return total_chunks   
-
-start = time.perf_counter()
-total_chunks = process_and_upload("../2_knowledge_base/knowledge_base")
-end = time.perf_counter()
-print(f"Проиндексировано {total_chunks} чанков! Время выполнения: {end - start} секунд")
+      stats.seconds += time.perf_counter() - start
+      stats.chunks += len(batch["ids"])
+
+
+def process_and_upload(directory, collection, emb_fn, reranker, embedding_cache, lexical):
+   paths = [
+      os.path.join(directory, filename)
+      for filename in sorted(os.listdir(directory))
+      if filename.endswith(".md")
+   ]
+   read_stats = StageStats("read+chunk")
+   embed_stats = StageStats("embed")
+   inject_stats = StageStats("injection")
+   write_stats = StageStats("write")
+
+   # Очередь ограничена, чтобы эмбеддинги не копились в памяти, если Chroma не успевает
+   batches = queue.Queue(maxsize=4)
+   write_errors = []
+   writer = threading.Thread(target=writer_loop, args=(collection, batches, write_stats, write_errors))
+   writer.start()
+
+   pending = {"ids": [], "documents": [], "metadatas": []}
+
+   def flush():
+      if not pending["ids"]:
+         return
+      docs = pending["documents"]
+      start = time.perf_counter()
+      # Эмбеддинги неизменившихся чанков берутся из кэша по хешу текста
+      embeddings = embedding_cache.embed(docs, emb_fn)
+      embed_stats.seconds += time.perf_counter() - start
+      embed_stats.chunks += len(docs)
+
+      # Опасность чанка не зависит от вопроса — считаем её один раз и кладём в метаданные
+      start = time.perf_counter()
+      inj_scores = injection_scores(reranker, docs)
+      inject_stats.seconds += time.perf_counter() - start
+      inject_stats.chunks += len(docs)
+
+      metas = [
+         {**meta, **injection_metadata(score, INJECTION_FINGERPRINT)}
+         for meta, score in zip(pending["metadatas"], inj_scores)
+      ]
+      # BM25-индекс для гибридного поиска строится по тем же чанкам
+      lexical.add(pending["ids"], docs)
+      batches.put({"ids": pending["ids"], "documents": docs, "metadatas": metas, "embeddings": embeddings})
+      for key in pending:
+         pending[key] = []
+
+   total_chunks = 0
+   try:
+      with ProcessPoolExecutor(max_workers=READ_WORKERS, initializer=init_chunker) as pool:
+         for filename, docs, elapsed in pool.map(read_and_chunk, paths, chunksize=8):
+            # Время читателей суммируется по процессам, делим на число процессов
+            read_stats.seconds += elapsed / READ_WORKERS
+            read_stats.chunks += len(docs)
+            if not docs:
+               continue
+            # id по содержимому чанка — те же id строит update_index при инкрементальном обновлении
+            pending["ids"].extend(content_chunk_ids(filename, [chunk_hash(doc) for doc in docs]))
+            pending["documents"].extend(docs)
+            pending["metadatas"].extend({"source": filename, "chunk_id": i} for i in range(len(docs)))
+            total_chunks += len(docs)
+            print(f"Chunked: {filename} ({len(docs)} chunks)")
+            if len(pending["ids"]) >= EMBED_BATCH_SIZE:
+               flush()
+         flush()
+   finally:
+      batches.put(None)
+      writer.join()
+   if write_errors:
+      raise write_errors[0]
+
+   print("\n--- Пропускная способность по этапам ---")
+   for stats in (read_stats, embed_stats, inject_stats, write_stats):
+      print(stats.report())
+   print(f"Кэш эмбеддингов: попаданий {embedding_cache.hits}, посчитано заново {embedding_cache.misses}")
+   return total_chunks
+
+
+def main():
+   report = StartupReport()
+   # Бэкенд (torch или onnx/int8) и число потоков задаются INFERENCE_BACKEND и INFERENCE_THREADS
+   with report.measure("embedder"):
+      emb_fn = load_embedding_function(EMBED_MODEL)
+   with report.measure("reranker"):
+      reranker = load_reranker(RERANK_MODEL)
+   with report.measure("embedding_cache"):
+      embedding_cache = EmbeddingCache(model_cache_key(EMBED_MODEL))
+   with report.measure("chroma"):
+      chroma_client = chromadb.PersistentClient(path="./my_vector_db")
+   print(f"Инициализация: {report.summary()}")
+
+   # Индекс строится в новую коллекцию, бот до переключения читает прежнюю
+   collection = chroma_client.create_collection(name=new_collection_name(), embedding_function=emb_fn)
+
+   lexical = BM25Index()
+
+   start = time.perf_counter()
+   try:
+      total_chunks = process_and_upload(
+         "../2_knowledge_base/knowledge_base", collection, emb_fn, reranker, embedding_cache, lexical
+      )
+      recall = smoke_check(chroma_client, collection, emb_fn, "./my_vector_db")
+      lexical.save(lexical_index_path("./my_vector_db", collection.name))
+   except Exception:
+      chroma_client.delete_collection(name=collection.name)
+      raise
+   if recall is not None:
+      print(f"Проверка на золотом наборе: ожидаемый источник найден для {recall:.0%} вопросов")
+   dropped = activate_collection(chroma_client, "./my_vector_db", collection.name)
+   drop_lexical_indexes("./my_vector_db", dropped)
+   print(f"Активная коллекция: {collection.name}" + (f", удалены старые: {', '.join(dropped)}" if dropped else ""))
+   # Опасность всех чанков посчитана этими зондами и моделью — update_index.py не станет пересчитывать её заново
+   write_injection_fingerprint("./my_vector_db", INJECTION_FINGERPRINT)
+   # Новая версия индекса: кэши бота по старой версии перестают совпадать
+   bump_index_version("./my_vector_db")
+   end = time.perf_counter()
+   print(f"Проиндексировано {total_chunks} чанков! Время выполнения: {end - start} секунд")
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import argparse
+import time
+import chromadb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rag_common.index_swap import GOLDEN_SET_PATH, read_active_collection
+from rag_common.models import (
+   ONNX_QUANTIZATION,
+   embedding_parity,
+   export_onnx,
+   load_embedding_function,
+   reranker_parity,
+)
+from rag_common.scoring import INJECTION_PROBES, INJECTION_THRESHOLD
+
+
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+RERANK_MODEL = os.getenv("RERANK_MODEL", "mixedbread-ai/mxbai-rerank-base-v1")
+VECTOR_DB_DIR = "./my_vector_db"
+# Сколько чанков из индекса на каждый вопрос золотого набора идёт в сверку
+PARITY_CANDIDATES = 10
+
+
+def parity_samples():
+   """Golden-set questions with the chunks the current index returns for them."""
+   with open(GOLDEN_SET_PATH, "r", encoding="utf-8") as f:
+      questions = [case["question"] for case in json.load(f)]
+
+   client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
+   collection = client.get_collection(
+      name=read_active_collection(VECTOR_DB_DIR),
+      embedding_function=load_embedding_function(EMBED_MODEL, "torch"),
+   )
+   results = collection.query(query_texts=questions, n_results=PARITY_CANDIDATES, include=["documents"])
+   return list(zip(questions, results["documents"]))
+
+
+def main():
+   parser = argparse.ArgumentParser(description="Экспорт моделей в ONNX/int8 и сверка с PyTorch")
+   parser.add_argument("--quantization", default=ONNX_QUANTIZATION, help="avx2, avx512, avx512_vnni, arm64 или none")
+   parser.add_argument("--skip-export", action="store_true", help="только сверка уже экспортированных моделей")
+   args = parser.parse_args()
+
+   if not args.skip_export:
+      for model_name, cross_encoder in ((EMBED_MODEL, False), (RERANK_MODEL, True)):
+         start = time.perf_counter()
+         path = export_onnx(model_name, cross_encoder=cross_encoder, quantization=args.quantization)
+         print(f"{model_name} -> {path} ({time.perf_counter() - start:.1f} с)")
+
+   samples = parity_samples()
+   texts = [question for question, _ in samples] + [doc for _, docs in samples for doc in docs]
+
+   embed_report = embedding_parity(EMBED_MODEL, texts, args.quantization)
+   print(f"Эмбеддинги: {embed_report}")
+   rerank_report = reranker_parity(
+      RERANK_MODEL,
+      samples,
+      args.quantization,
+      probes=INJECTION_PROBES,
+      injection_threshold=INJECTION_THRESHOLD,
+   )
+   print(f"Cross-encoder: {rerank_report}")
+
+   if not (embed_report["ok"] and rerank_report["ok"]):
+      print("ONNX-модели расходятся с PyTorch сильнее допустимого, INFERENCE_BACKEND=onnx включать не стоит")
+      sys.exit(1)
+   print("Сверка пройдена, можно включать INFERENCE_BACKEND=onnx")
+
+
+if __name__ == "__main__":
+   main()
@@ -16,31 +16,61 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
+import time
+
+# Отсчёт времени старта — до тяжёлых импортов
+STARTED_AT = time.perf_counter()
+
 import logging
 
 import os
+import sys
 from dotenv import load_dotenv
 from telegram import ForceReply, Update
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
-from chromadb.utils import embedding_functions
-from sentence_transformers import CrossEncoder
-import chromadb
-from openai import OpenAI
+from openai import AsyncOpenAI
 
+load_dotenv()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rag_common.index_swap import ActiveCollection  # noqa: E402
+from rag_common.inference import InferencePool, INFERENCE_WORKERS, MAX_CONCURRENT_QUERIES  # noqa: E402
+from rag_common.lazy import WARM_UP, Lazy, StartupReport, warm_up  # noqa: E402
+from rag_common.models import load_embedding_function, load_reranker  # noqa: E402
+from rag_common.prompt import ChatPrompt, build_context, llm_extra_body  # noqa: E402
 
-chroma_client = chromadb.PersistentClient(path="../3_vector_DB/my_vector_db")
-client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
-emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="E:/models/paraphrase-multilingual-MiniLM-L12-v2"
-    # model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-)
-collection = chroma_client.get_collection(
-    name="kb_v1", 
-    embedding_function=emb_fn
+
+VECTOR_DB_DIR = "../3_vector_DB/my_vector_db"
+EMBED_MODEL = "E:/models/paraphrase-multilingual-MiniLM-L12-v2"
+# EMBED_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+# RERANK_MODEL = "mixedbread-ai/mxbai-rerank-base-v1"
+RERANK_MODEL = "E:/models/mxbai-rerank-base-v1"
+
+
+def open_chroma():
+    import chromadb
+
+    return chromadb.PersistentClient(path=VECTOR_DB_DIR)
+
+
+def open_collection():
+    # Коллекцию, на которую указывает индексатор, перечитываем на каждом запросе — переиндексация без перезапуска бота
+    return ActiveCollection(open_chroma(), VECTOR_DB_DIR, emb_fn.get(), open_chroma)
+
+
+# Модели и Chroma создаются при первом обращении (или фоновым прогревом), поэтому бот
+# отвечает на /start сразу после запуска
+startup_report = StartupReport(STARTED_AT)
+startup_report.record("imports", time.perf_counter() - STARTED_AT)
+client = AsyncOpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
+emb_fn = Lazy("embedder", lambda: load_embedding_function(EMBED_MODEL), startup_report)
+active_collection = Lazy("collection", open_collection, startup_report)
+reranker = Lazy("reranker", lambda: load_reranker(RERANK_MODEL), startup_report)
+# Шаблоны читаются один раз и перечитываются только после правки файлов. Статическая часть
+# (system_prompt.txt) идёт первой — LLM-сервер переиспользует её KV-кэш между запросами.
+chat_prompt = ChatPrompt(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.txt"),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_template.txt"),
 )
-# reranker = CrossEncoder('mixedbread-ai/mxbai-rerank-base-v1') 
-reranker = CrossEncoder('E:/models/mxbai-rerank-base-v1') 
-load_dotenv()
 
 # Enable logging
 logging.basicConfig(
@@ -51,6 +81,10 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 logger = logging.getLogger(__name__)
 
+# Эмбеддинги, поиск в Chroma и cross-encoder выполняются в пуле потоков,
+# чтобы долгий запрос одного пользователя не блокировал остальные чаты.
+inference_pool = InferencePool(INFERENCE_WORKERS)
+
 
 # Define a few command handlers. These usually take the two arguments update and
 # context.
@@ -70,7 +104,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_query = update.message.text
-    results = collection.query(
+    collection, _, _ = await inference_pool.run(lambda: active_collection.get().get())
+    results = await inference_pool.run(
+        collection.query,
         query_texts=[user_query],
         n_results=10
     )
@@ -78,7 +114,7 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     documents = results['documents'][0]
     metadatas = results['metadatas'][0]
     pairs = [[user_query, doc] for doc in documents]
-    scores = await reranker.predict(pairs)
+    scores = await inference_pool.run(lambda: reranker.get().predict(pairs))
     reranked_results = sorted(
         zip(documents, scores, metadatas), 
         key=lambda x: x[1], 
@@ -90,30 +126,36 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         source = results['metadatas'][0][i]['source']
         print(f"[{i+1}] Дистанция: {dist:.4f} | Текст: {doc}")
      
-    results_encoded = ""
-
-    for i, (doc, score, meta) in enumerate(reranked_results):
-    # Ограничим вывод, скажем, топ-5 самыми релевантными
-        if i >= 5: break 
-        results_encoded = f"{results_encoded}[{i+1}] Источник[{meta['source']}] Релевантность: {score:.4f} | Текст: {doc}\n\n"
-
-    promp_template = str()
-    with open('./prompt_template.txt', 'r', encoding='utf-8') as file:
-                promp_template = file.read() or str()
-    prompt = promp_template.replace("{{docs}}", results_encoded)
-    prompt = prompt.replace("{{user_question}}", user_query)
+    # Топ-5 самых релевантных в пределах бюджета токенов контекста
+    context_block = build_context([(doc, meta['source'], float(score)) for doc, score, meta in reranked_results])
+    messages = chat_prompt.messages(docs=context_block.text, user_question=user_query)
     
-    print(prompt)
-    response = client.chat.completions.create(
+    print(messages[-1]["content"])
+    response = await client.chat.completions.create(
         model="local-model", # LM Studio игнорирует это имя и использует загруженную модель
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
+        messages=messages,
         temperature=0.7,
+        extra_body=llm_extra_body(),
     )
     await update.message.reply_text(response.choices[0].message.content)
 
 
+async def start_warm_up(application: Application) -> None:
+    """Report startup time and build models in the background while the poller is already running."""
+    logger.info(
+        "Бот запущен за %.2f с (модели загружаются %s)",
+        time.perf_counter() - STARTED_AT,
+        "в фоне" if WARM_UP else "по первому запросу",
+    )
+    if WARM_UP:
+        warm_up([emb_fn, active_collection, reranker], startup_report)
+
+
+async def shutdown_workers(application: Application) -> None:
+    """Stop the inference pool when the bot stops."""
+    inference_pool.shutdown(wait=False)
+
+
 def main() -> None:
     BOT_TOKEN_FILE:str = os.getenv("BOT_TOKEN_FILE") or str()
     __token:str=""
@@ -127,7 +169,16 @@ def main() -> None:
 
     """Start the bot."""
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(__token).build()
+    # concurrent_updates: сообщения разных пользователей обрабатываются параллельно,
+    # а не в очереди за одним долгим ответом LLM.
+    application = (
+        Application.builder()
+        .token(__token)
+        .concurrent_updates(MAX_CONCURRENT_QUERIES)
+        .post_init(start_warm_up)
+        .post_shutdown(shutdown_workers)
+        .build()
+    )
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -1,13 +1,32 @@
 import os
-from chromadb.utils import embedding_functions
+import sys
 import chromadb
 from chonkie import SentenceChunker
 import time
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rag_common.chunking import chunk_hash, content_chunk_ids
+from rag_common.index_swap import (
+   activate_standby,
+   open_standby,
+   read_active_collection,
+   smoke_check,
+)
+from rag_common.lexical import drop_lexical_indexes, lexical_index_path, load_lexical_index
+from rag_common.models import load_embedding_function, load_reranker, model_cache_key
+from rag_common.retrieval import bump_index_version
+from rag_common.scoring import injection_fingerprint, injection_metadata, injection_scores
+
 
 EMBED_MODEL = "E:/models/paraphrase-multilingual-MiniLM-L12-v2"
 # EMBED_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBED_MODEL)
+emb_fn = load_embedding_function(EMBED_MODEL)
+
+# Cross-encoder нужен только для предрасчёта опасности чанков (зонды инъекций)
+RERANK_MODEL = "E:/models/mxbai-rerank-base-v1"
+# RERANK_MODEL = "mixedbread-ai/mxbai-rerank-base-v1"
+reranker = load_reranker(RERANK_MODEL)
+INJECTION_FINGERPRINT = injection_fingerprint(model_cache_key(RERANK_MODEL))
 
 # 2. Инициализируем чанкер правильно (под токены)
 chunker = SentenceChunker(
@@ -16,8 +35,14 @@ chunker = SentenceChunker(
     chunk_overlap=15
 )
 
-chroma_client = chromadb.PersistentClient(path="../3_vector_DB/my_vector_db")
-collection = chroma_client.get_or_create_collection(name="kb_v1", embedding_function=emb_fn)
+VECTOR_DB_DIR = "../3_vector_DB/my_vector_db"
+chroma_client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
+# Опасные документы добавляются в запасную версию, догнанную до активной; бот переключится на неё после проверки
+active_name = read_active_collection(VECTOR_DB_DIR)
+collection, standby = open_standby(chroma_client, VECTOR_DB_DIR, emb_fn, chroma_client.get_max_batch_size())
+print(f"Коллекция {collection.name}: {standby['mode']}, скопировано чанков {standby['replayed']}")
+# BM25-индекс новой версии — индекс активной плюс опасные документы
+lexical = load_lexical_index(VECTOR_DB_DIR, collection, active_name)
 
 
 def process_and_upload(directory):
@@ -33,18 +58,34 @@ def process_and_upload(directory):
       chunks = chunker.chunk(text)
       
       # Готовим батч для одного файла
-      ids = [f"{filename}_{i}" for i in range(len(chunks))]
       docs = [c.text for c in chunks]
-      metas = [{"source": filename, "chunk_id": i} for i in range(len(chunks))]
+      ids = content_chunk_ids(filename, [chunk_hash(doc) for doc in docs])
+      # Опасность чанка не зависит от вопроса — считаем её один раз и кладём в метаданные
+      inj_scores = injection_scores(reranker, docs)
+      metas = [
+         {"source": filename, "chunk_id": i, **injection_metadata(inj_scores[i], INJECTION_FINGERPRINT)}
+         for i in range(len(chunks))
+      ]
       
       # Добавляем в базу (тут можно добавить проверку на пустой docs)
       if docs:
-         collection.add(documents=docs, metadatas=metas, ids=ids)
+         collection.upsert(documents=docs, metadatas=metas, ids=ids)
+         lexical.add(ids, docs)
          print(f"Indexed: {filename} ({len(docs)} chunks)")
          total_chunks += len(docs)
    return total_chunks   
 
 start = time.perf_counter()
-total_chunks = process_and_upload("./evil_docs")
+try:
+   total_chunks = process_and_upload("./evil_docs")
+   smoke_check(chroma_client, collection, emb_fn, VECTOR_DB_DIR)
+   lexical.save(lexical_index_path(VECTOR_DB_DIR, collection.name))
+except Exception:
+   chroma_client.delete_collection(name=collection.name)
+   drop_lexical_indexes(VECTOR_DB_DIR, [collection.name])
+   raise
+drop_lexical_indexes(VECTOR_DB_DIR, activate_standby(chroma_client, VECTOR_DB_DIR, collection))
+# Новая версия индекса: кэши бота по старой версии перестают совпадать
+bump_index_version(VECTOR_DB_DIR)
 end = time.perf_counter()
 print(f"Проиндексировано {total_chunks} чанков! Время выполнения: {end - start} секунд")
@@ -1,31 +1,50 @@
-import chromadb
-from chromadb.utils import embedding_functions
+import os
+import sys
+import time
 
-# 1. Подключаемся к той же папке
-chroma_client = chromadb.PersistentClient(path="../3_vector_DB/my_vector_db")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rag_common.index_swap import read_active_collection
+from rag_common.lazy import Lazy, StartupReport, warm_up
+from rag_common.models import load_embedding_function
 
-# 2. Указываем ТУ ЖЕ модель эмбеддингов
-emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="E:/models/paraphrase-multilingual-MiniLM-L12-v2"
-    # model_name="sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-)
+VECTOR_DB_DIR = "../3_vector_DB/my_vector_db"
+# EMBED_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+EMBED_MODEL = "E:/models/paraphrase-multilingual-MiniLM-L12-v2"
 
-# 3. Получаем существующую коллекцию
-collection = chroma_client.get_collection(
-    name="kb_v1", 
-    embedding_function=emb_fn
-)
+
+def open_collection():
+   import chromadb
+
+   # 1. Подключаемся к той же папке
+   chroma_client = chromadb.PersistentClient(path=VECTOR_DB_DIR)
+   # 2. Указываем ТУ ЖЕ модель эмбеддингов
+   emb_fn = load_embedding_function(EMBED_MODEL)
+   # 3. Получаем существующую коллекцию
+   return chroma_client.get_collection(
+      name=read_active_collection(VECTOR_DB_DIR),
+      embedding_function=emb_fn
+   )
+
+
+# Модель грузится в фоне, пока пользователь набирает первый вопрос
+startup_report = StartupReport()
+collection = Lazy("collection", open_collection, startup_report)
+warm_up([collection])
 
 
 # 4. Цикл для общения (мини-чат)
-print("База готова. Спрашивай что угодно (или напиши 'exit' для выхода):")
+print(f"Спрашивай что угодно (или напиши 'exit' для выхода). Старт за {time.perf_counter() - startup_report.started:.2f} с:")
 
 while True:
    user_query = input("\nВаш вопрос: ")
    if user_query.lower() in ['exit', 'quit', 'выход']:
       break
       
-   results = collection.query(
+   if not collection.loaded:
+      print("Загрузка модели...")
+      collection.get()
+      print(f"Готово: {startup_report.summary()}")
+   results = collection.get().query(
       query_texts=[user_query],
       n_results=10
    )
@@ -2,24 +2,57 @@ import os
 import json
 import hashlib
 import logging
+import argparse
 import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
-from chromadb.utils import embedding_functions
-import chromadb
-from chonkie import SentenceChunker
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, ".."))
+from rag_common.chunking import chunk_hash, content_chunk_ids  # noqa: E402
+from rag_common.embedding_cache import EmbeddingCache  # noqa: E402
+from rag_common.index_swap import (  # noqa: E402
+    activate_standby,
+    open_standby,
+    read_active_collection,
+    smoke_check,
+)
+from rag_common.journal import UpdateJournal, write_json_atomic  # noqa: E402
+from rag_common.lazy import StartupReport  # noqa: E402
+from rag_common.lexical import drop_lexical_indexes, lexical_index_path, load_lexical_index  # noqa: E402
+from rag_common.manifest import entry_chunks, entry_md5, entry_stat, with_stat  # noqa: E402
+from rag_common.models import INFERENCE_BACKEND, load_embedding_function, load_reranker, model_cache_key  # noqa: E402
+from rag_common.retrieval import bump_index_version  # noqa: E402
+from rag_common.scoring import (  # noqa: E402
+    injection_fingerprint,
+    injection_metadata,
+    injection_scores,
+    read_injection_fingerprint,
+    stored_injection_score,
+    write_injection_fingerprint,
+)
+
 KB_DIR = os.path.join(SCRIPT_DIR, "..", "2_knowledge_base", "knowledge_base")
 VECTOR_DB_DIR = os.path.join(SCRIPT_DIR, "..", "3_vector_DB", "my_vector_db")
 MANIFEST_PATH = os.path.join(SCRIPT_DIR, ".manifest.json")
+# Журнал незавершённого обновления: по нему манифест восстанавливается после падения
+JOURNAL_PATH = os.path.join(SCRIPT_DIR, ".update_journal.jsonl")
 
 EMBED_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
-COLLECTION_NAME = "kb_v1"
+RERANK_MODEL = "mixedbread-ai/mxbai-rerank-base-v1"
+# Сохранённая опасность чанков действительна, пока не сменились зонды и cross-encoder (модель и бэкенд)
+INJECTION_FINGERPRINT = injection_fingerprint(model_cache_key(RERANK_MODEL))
 
 CHUNK_SIZE = 300
 CHUNK_OVERLAP = 50
 
+# MD5 считается только для файлов, у которых изменились размер или mtime
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "8"))
+# Режим --watch: изменения, пришедшие в пределах этого окна, обрабатываются одним обновлением
+WATCH_DEBOUNCE_MS = int(os.getenv("WATCH_DEBOUNCE_MS", "2000"))
+
 logger = logging.getLogger("update_index")
 
 
@@ -39,133 +72,451 @@ def load_manifest() -> dict:
 
 
 def save_manifest(manifest: dict):
-    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
-        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    write_json_atomic(MANIFEST_PATH, manifest)
+
+
+def recover_interrupted_update(journal: UpdateJournal):
+    """Fold a journal left by a crashed update into the manifest before scanning."""
+    recovered = journal.recover(load_manifest())
+    if recovered is not None:
+        logger.warning("Найден журнал прерванного обновления — восстанавливаем манифест")
+        save_manifest(recovered)
+        # Коллекция могла успеть измениться — кэши бота по старой версии недействительны
+        bump_index_version(os.path.normpath(VECTOR_DB_DIR))
+    journal.clear()
+
+
+def scan_documents(kb_dir: str, old_manifest: dict, only=None):
+    """Compare current files against the manifest to find new, modified, and deleted documents.
+
+    Files whose size and mtime match the manifest are taken as unchanged without
+    being read; the rest are MD5-hashed in a thread pool. ``only`` restricts the
+    scan to the given file names (as reported by the watcher); every other file
+    in the manifest is assumed unchanged.
+    Returns current_files (name -> {"md5", "size", "mtime_ns"} for scanned files)
+    and the lists of new, modified, deleted and unchanged file names.
+    """
+    stats = {}
+    if only is None:
+        with os.scandir(kb_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".md") and entry.is_file():
+                    st = entry.stat()
+                    stats[entry.name] = (st.st_size, st.st_mtime_ns)
+    else:
+        for fname in only:
+            fpath = os.path.join(kb_dir, fname)
+            if fname.endswith(".md") and os.path.isfile(fpath):
+                st = os.stat(fpath)
+                stats[fname] = (st.st_size, st.st_mtime_ns)
 
-
-def scan_documents(kb_dir: str, old_manifest: dict):
-    """Compare current files against the manifest to find new, modified, and deleted documents."""
     current_files = {}
-    for fname in os.listdir(kb_dir):
-        if not fname.endswith(".md"):
-            continue
-        fpath = os.path.join(kb_dir, fname)
-        if os.path.isfile(fpath):
-            current_files[fname] = file_md5(fpath)
+    to_hash = []
+    for fname, (size, mtime_ns) in stats.items():
+        old_entry = old_manifest.get(fname)
+        if entry_stat(old_entry) == (size, mtime_ns):
+            current_files[fname] = {"md5": entry_md5(old_entry), "size": size, "mtime_ns": mtime_ns}
+        else:
+            to_hash.append(fname)
+
+    logger.debug("Размер или mtime изменились у %d файлов из %d", len(to_hash), len(stats))
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+            hashes = pool.map(lambda fname: file_md5(os.path.join(kb_dir, fname)), to_hash)
+            for fname, md5 in zip(to_hash, hashes):
+                size, mtime_ns = stats[fname]
+                current_files[fname] = {"md5": md5, "size": size, "mtime_ns": mtime_ns}
 
     new_files = []
     modified_files = []
     unchanged_files = []
 
-    for fname, md5 in current_files.items():
+    for fname, info in current_files.items():
         if fname not in old_manifest:
             new_files.append(fname)
-        elif old_manifest[fname] != md5:
+        elif entry_md5(old_manifest[fname]) != info["md5"]:
             modified_files.append(fname)
         else:
             unchanged_files.append(fname)
 
-    deleted_files = [f for f in old_manifest if f not in current_files]
+    if only is None:
+        deleted_files = [f for f in old_manifest if f not in current_files]
+    else:
+        deleted_files = [f for f in only if f in old_manifest and f not in current_files]
+        unchanged_files.extend(f for f in old_manifest if f not in only)
 
     return current_files, new_files, modified_files, deleted_files, unchanged_files
 
 
-def delete_chunks_for_file(collection, filename: str):
-    """Remove all chunks belonging to a given source file."""
-    existing = collection.get(where={"source": filename})
-    if existing["ids"]:
-        collection.delete(ids=existing["ids"])
-        logger.info("Удалено %d чанков для '%s'", len(existing["ids"]), filename)
+def ids_by_source(collection, sources) -> dict[str, list[str]]:
+    """Chunk ids of the given source files, in chunk order, fetched with one ``$in`` query."""
+    result = {source: [] for source in sources}
+    if not result:
+        return result
+    existing = collection.get(where={"source": {"$in": list(result)}}, include=["metadatas"])
+    positioned = sorted(
+        ((meta or {}).get("chunk_id", 0), chunk_id, (meta or {}).get("source"))
+        for chunk_id, meta in zip(existing["ids"], existing["metadatas"])
+    )
+    for _, chunk_id, source in positioned:
+        result.setdefault(source, []).append(chunk_id)
+    return result
 
 
-def upsert_file(collection, chunker, kb_dir: str, filename: str) -> int:
-    """Chunk a file and upsert its chunks into the collection. Returns chunk count."""
+@contextmanager
+def timed(timings: dict, phase: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+def batched(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def read_chunks(chunker, kb_dir: str, filename: str) -> list[str]:
     fpath = os.path.join(kb_dir, filename)
     with open(fpath, "r", encoding="utf-8") as f:
         text = f.read()
 
     if not text.strip():
-        logger.warning("Файл '%s' пуст, пропуск", filename)
+        logger.warning("Файл '%s' пуст, чанков не будет", filename)
+        return []
+
+    return [c.text for c in chunker.chunk(text)]
+
+
+def diff_chunks(filename: str, docs: list[str], old_ids: list[str]):
+    """Compare the new chunks of a file with the ids it has in the collection.
+
+    Returns the new chunk hashes and ids, the ids to remove, and the positions
+    of chunks that have to be written (new text) or only moved (same text,
+    different position).
+    """
+    hashes = [chunk_hash(doc) for doc in docs]
+    new_ids = content_chunk_ids(filename, hashes)
+    old_positions = {chunk_id: i for i, chunk_id in enumerate(old_ids)}
+    new_set = set(new_ids)
+    removed = [chunk_id for chunk_id in old_ids if chunk_id not in new_set]
+    added = [i for i, chunk_id in enumerate(new_ids) if chunk_id not in old_positions]
+    moved = [i for i, chunk_id in enumerate(new_ids) if old_positions.get(chunk_id, i) != i]
+    return hashes, new_ids, removed, added, moved
+
+
+def refresh_injection_scores(collection, reranker, batch_size: int) -> int:
+    """Rescore chunks whose stored injection score is missing or stale. Returns chunk count."""
+    existing = collection.get(include=["documents", "metadatas"])
+    stale = [
+        (chunk_id, doc, meta or {})
+        for chunk_id, doc, meta in zip(existing["ids"], existing["documents"], existing["metadatas"])
+        if stored_injection_score(meta, INJECTION_FINGERPRINT) is None
+    ]
+    if not stale:
         return 0
 
-    chunks = chunker.chunk(text)
-    ids = [f"{filename}_{i}" for i in range(len(chunks))]
-    docs = [c.text for c in chunks]
-    metas = [{"source": filename, "chunk_id": i} for i in range(len(chunks))]
-
-    if docs:
-        collection.upsert(documents=docs, metadatas=metas, ids=ids)
-
-    return len(docs)
-
-
-def main():
-    log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
-    logging.basicConfig(
-        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-        level=getattr(logging, log_level, logging.INFO),
-    )
-
-    logger.info("=== Запуск обновления индекса ===")
+    scores = injection_scores(reranker, [doc or "" for _, doc, _ in stale])
+    rescored = [
+        (chunk_id, {**meta, **injection_metadata(score, INJECTION_FINGERPRINT)})
+        for (chunk_id, _, meta), score in zip(stale, scores)
+    ]
+    for batch in batched(rescored, batch_size):
+        collection.update(ids=[chunk_id for chunk_id, _ in batch], metadatas=[meta for _, meta in batch])
+    return len(stale)
+
+
+def apply_changes(collection, lexical, resources, kb_dir: str, old_manifest: dict, current_files: dict,
+                  deleted_files: list, modified_files: list, new_files: list, timings: dict):
+    """Apply the scanned changes to ``collection`` and its BM25 index ``lexical``.
+
+    Returns the new manifest entries of the changed files (None for deleted
+    ones) and the counts of added, removed and moved chunks.
+    """
+    max_batch = resources.max_batch_size
+
+    # Все изменения собираются в памяти и пишутся в коллекцию общими пачками, а не по файлу
+    removed_ids = []
+    pending = {"ids": [], "documents": [], "metadatas": []}
+    moved = {}
+    file_entries = {}
+
+    with timed(timings, "diff"):
+        # Файлы без списка чанков в манифесте: их id берутся из коллекции одним запросом
+        changed_files = deleted_files + modified_files + new_files
+        unknown = ids_by_source(collection, [f for f in changed_files if entry_chunks(old_manifest.get(f)) is None])
+
+        def old_ids(fname):
+            if fname in unknown:
+                return unknown[fname]
+            return content_chunk_ids(fname, entry_chunks(old_manifest[fname]))
+
+        for fname in deleted_files:
+            logger.info("Удаление устаревшего документа: %s", fname)
+            removed_ids.extend(old_ids(fname))
+            file_entries[fname] = None
+
+        for fname in modified_files + new_files:
+            if fname in old_manifest:
+                logger.info("Обновление изменённого документа: %s", fname)
+            else:
+                logger.info("Индексация нового документа: %s", fname)
+            docs = read_chunks(resources.chunker, kb_dir, fname)
+            hashes, new_ids, removed, added, moved_positions = diff_chunks(fname, docs, old_ids(fname))
+            removed_ids.extend(removed)
+            for i in added:
+                pending["ids"].append(new_ids[i])
+                pending["documents"].append(docs[i])
+                pending["metadatas"].append({"source": fname, "chunk_id": i})
+            for i in moved_positions:
+                moved[new_ids[i]] = (fname, i)
+            file_entries[fname] = {**current_files[fname], "chunks": hashes}
+            logger.info(
+                "  -> добавлено %d, удалено %d, сдвинуто %d чанков", len(added), len(removed), len(moved_positions)
+            )
+
+    with timed(timings, "delete"):
+        for batch in batched(removed_ids, max_batch):
+            collection.delete(ids=batch)
+        lexical.remove(removed_ids)
+
+    with timed(timings, "embed"):
+        # Эмбеддинги неизменившихся текстов берутся из кэша, остальные считаются одним прогоном
+        embeddings = resources.embed(pending["documents"])
+
+    with timed(timings, "injection"):
+        # Опасность чанка не зависит от вопроса — считаем её один раз и кладём в метаданные
+        inj_scores = injection_scores(resources.reranker, pending["documents"])
+        pending["metadatas"] = [
+            {**meta, **injection_metadata(score, INJECTION_FINGERPRINT)}
+            for meta, score in zip(pending["metadatas"], inj_scores)
+        ]
+
+    with timed(timings, "upsert"):
+        for i in range(0, len(pending["ids"]), max_batch):
+            collection.upsert(
+                ids=pending["ids"][i:i + max_batch],
+                documents=pending["documents"][i:i + max_batch],
+                metadatas=pending["metadatas"][i:i + max_batch],
+                embeddings=embeddings[i:i + max_batch],
+            )
+        lexical.add(pending["ids"], pending["documents"])
+
+    with timed(timings, "move"):
+        # Текст и вектор не менялись — обновляем только позицию чанка в метаданных
+        for batch in batched(list(moved), max_batch):
+            existing = collection.get(ids=batch, include=["metadatas"])
+            meta_by_id = dict(zip(existing["ids"], existing["metadatas"]))
+            collection.update(
+                ids=batch,
+                metadatas=[
+                    {**(meta_by_id.get(chunk_id) or {}), "source": moved[chunk_id][0], "chunk_id": moved[chunk_id][1]}
+                    for chunk_id in batch
+                ],
+            )
+
+    return file_entries, {"added": len(pending["ids"]), "removed": len(removed_ids), "moved": len(moved)}
+
+
+class IndexResources:
+    """Models, chunker and Chroma client, loaded on first use and kept between watch-mode updates.
+
+    chromadb, chonkie and the model libraries are imported here too, so a run
+    that finds nothing to update (or ``--help``) never pays for them.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.db_dir = os.path.normpath(VECTOR_DB_DIR)
+        self.startup_report = StartupReport()
+
+    def load(self):
+        if self.client is not None:
+            return
+
+        report = self.startup_report
+        logger.info("Загрузка модели эмбеддингов: %s (%s)", EMBED_MODEL, INFERENCE_BACKEND)
+        with report.measure("embedder"):
+            self.emb_fn = load_embedding_function(EMBED_MODEL)
+
+        logger.info("Загрузка cross-encoder для зондов инъекций: %s (%s)", RERANK_MODEL, INFERENCE_BACKEND)
+        with report.measure("reranker"):
+            self.reranker = load_reranker(RERANK_MODEL)
+
+        with report.measure("embedding_cache"):
+            # Эмбеддинги чанков, чей текст уже встречался, берутся из кэша и не пересчитываются
+            self.embedding_cache = EmbeddingCache(model_cache_key(EMBED_MODEL))
+
+        with report.measure("chunker"):
+            from chonkie import SentenceChunker
+
+            self.chunker = SentenceChunker(tokenizer="character", chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+        with report.measure("chroma"):
+            import chromadb
+
+            self.client = chromadb.PersistentClient(path=self.db_dir)
+            # Все записи в коллекцию идут пачками максимального размера, который принимает Chroma
+            self.max_batch_size = self.client.get_max_batch_size()
+        logger.info("Ресурсы загружены: %s", report.summary())
+
+    def embed(self, docs):
+        return self.embedding_cache.embed(docs, self.emb_fn)
+
+
+def run_update(kb_dir: str, resources: IndexResources, only=None):
     start = time.perf_counter()
 
-    kb_dir = os.path.normpath(KB_DIR)
-    if not os.path.isdir(kb_dir):
-        logger.error("Директория базы знаний не найдена: %s", kb_dir)
-        sys.exit(1)
+    journal = UpdateJournal(JOURNAL_PATH)
+    recover_interrupted_update(journal)
 
     old_manifest = load_manifest()
-    current_files, new_files, modified_files, deleted_files, unchanged_files = scan_documents(kb_dir, old_manifest)
+    current_files, new_files, modified_files, deleted_files, unchanged_files = scan_documents(
+        kb_dir, old_manifest, only
+    )
 
     logger.info(
         "Сканирование: всего=%d, новых=%d, изменённых=%d, удалённых=%d, без изменений=%d",
-        len(current_files), len(new_files), len(modified_files), len(deleted_files), len(unchanged_files),
+        len(new_files) + len(modified_files) + len(unchanged_files), len(new_files), len(modified_files),
+        len(deleted_files), len(unchanged_files),
     )
 
-    if not new_files and not modified_files and not deleted_files:
+    new_manifest = {fname: with_stat(old_manifest[fname], current_files.get(fname)) for fname in unchanged_files}
+
+    probes_changed = read_injection_fingerprint(resources.db_dir) != INJECTION_FINGERPRINT
+    if probes_changed:
+        logger.info("Список зондов инъекций или cross-encoder изменились — опасность чанков будет пересчитана")
+
+    if not new_files and not modified_files and not deleted_files and not probes_changed:
+        if new_manifest != old_manifest:
+            # Содержимое не менялось, но у файлов сменились mtime — запоминаем, чтобы не хешировать их снова
+            save_manifest(new_manifest)
         logger.info("Изменений не обнаружено — обновление не требуется")
         elapsed = time.perf_counter() - start
         logger.info("Завершено за %.2f сек", elapsed)
         return
 
-    logger.info("Загрузка модели эмбеддингов: %s", EMBED_MODEL)
-    emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBED_MODEL)
+    timings = {"scan": time.perf_counter() - start}
+    resources.load()
+    embedding_cache = resources.embedding_cache
+    hits_before, misses_before = embedding_cache.hits, embedding_cache.misses
+
+    # Сначала журнал, потом изменения коллекции: после падения по нему видно, какие файлы не доделаны
+    journal.begin({
+        **{fname: "delete" for fname in deleted_files},
+        **{fname: "sync" for fname in modified_files + new_files},
+    })
+
+    # Изменения пишутся в запасную версию, догнанную до активной: бот до переключения читает прежнюю целиком
+    with timed(timings, "standby"):
+        active_name = read_active_collection(resources.db_dir)
+        collection, standby = open_standby(
+            resources.client, resources.db_dir, resources.emb_fn, resources.max_batch_size
+        )
+        lexical = load_lexical_index(resources.db_dir, collection, active_name)
+    if standby["mode"] == "replay":
+        logger.info("Запасная коллекция %s догнана до активной: скопировано чанков %d", collection.name, standby["replayed"])
+    else:
+        logger.info("Освободившейся запасной коллекции нет — активная скопирована в %s", collection.name)
+
+    try:
+        file_entries, counts = apply_changes(
+            collection, lexical, resources, kb_dir, old_manifest, current_files,
+            deleted_files, modified_files, new_files, timings,
+        )
+
+        if probes_changed:
+            with timed(timings, "probes"):
+                n = refresh_injection_scores(collection, resources.reranker, resources.max_batch_size)
+            logger.info("Пересчитана опасность %d чанков", n)
+
+        with timed(timings, "smoke"):
+            recall = smoke_check(resources.client, collection, resources.emb_fn, resources.db_dir)
+        lexical.save(lexical_index_path(resources.db_dir, collection.name))
+    except Exception:
+        resources.client.delete_collection(name=collection.name)
+        drop_lexical_indexes(resources.db_dir, [collection.name])
+        raise
+
+    if recall is not None:
+        logger.info("Золотой набор: ожидаемый источник найден для %.0f%% вопросов", recall * 100)
+    dropped = activate_standby(resources.client, resources.db_dir, collection)
+    logger.info("Активная коллекция: %s (была %s)", collection.name, active_name)
+    if dropped:
+        drop_lexical_indexes(resources.db_dir, dropped)
+        logger.info("Удалены старые версии коллекции: %s", ", ".join(dropped))
+
+    journal.done(file_entries)
+    for fname, entry in file_entries.items():
+        if entry is not None:
+            new_manifest[fname] = entry
+
+    with timed(timings, "manifest"):
+        save_manifest(new_manifest)
+        write_injection_fingerprint(resources.db_dir, INJECTION_FINGERPRINT)
+        # Кэши бота привязаны к версии индекса и после смены версии перестают совпадать
+        bump_index_version(resources.db_dir)
+        journal.clear()
 
-    chunker = SentenceChunker(tokenizer="character", chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    elapsed = time.perf_counter() - start
+    logger.info("=== Обновление завершено ===")
+    logger.info("Добавлено чанков: %d", counts["added"])
+    logger.info("Удалено чанков: %d", counts["removed"])
+    logger.info("Сдвинуто чанков: %d", counts["moved"])
+    logger.info(
+        "Кэш эмбеддингов: попаданий %d, посчитано заново %d",
+        embedding_cache.hits - hits_before, embedding_cache.misses - misses_before,
+    )
+    logger.info("Время по этапам: %s", ", ".join(f"{phase}={sec:.2f}с" for phase, sec in timings.items()))
+    logger.info("Время: %.2f сек", elapsed)
 
-    db_dir = os.path.normpath(VECTOR_DB_DIR)
-    chroma_client = chromadb.PersistentClient(path=db_dir)
-    collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME, embedding_function=emb_fn)
 
-    total_added = 0
-    total_deleted_chunks = 0
+def watch_updates(kb_dir: str, resources: IndexResources):
+    """Re-run the update for the files reported by inotify (via watchfiles) until interrupted."""
+    from watchfiles import watch
 
-    for fname in deleted_files:
-        logger.info("Удаление устаревшего документа: %s", fname)
-        existing = collection.get(where={"source": fname})
-        total_deleted_chunks += len(existing["ids"])
-        delete_chunks_for_file(collection, fname)
+    logger.info("Наблюдение за %s (Ctrl-C для выхода)", kb_dir)
+    for changes in watch(
+        kb_dir,
+        watch_filter=lambda change, path: path.endswith(".md"),
+        debounce=WATCH_DEBOUNCE_MS,
+        recursive=False,
+    ):
+        changed = {os.path.basename(path) for _, path in changes}
+        logger.info("Изменены файлы: %s", ", ".join(sorted(changed)))
+        try:
+            run_update(kb_dir, resources, only=changed)
+        except Exception:
+            # Журнал остался на диске — следующее обновление восстановит манифест и доделает файлы
+            logger.exception("Ошибка обновления индекса, продолжаем наблюдение")
 
-    for fname in modified_files:
-        logger.info("Обновление изменённого документа: %s", fname)
-        delete_chunks_for_file(collection, fname)
-        n = upsert_file(collection, chunker, kb_dir, fname)
-        total_added += n
-        logger.info("  -> добавлено %d чанков", n)
 
-    for fname in new_files:
-        logger.info("Индексация нового документа: %s", fname)
-        n = upsert_file(collection, chunker, kb_dir, fname)
-        total_added += n
-        logger.info("  -> добавлено %d чанков", n)
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальное обновление векторного индекса")
+    parser.add_argument("--watch", action="store_true", help="после обновления следить за базой знаний и обновлять индекс при изменениях")
+    args = parser.parse_args()
 
-    save_manifest(current_files)
+    log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+        level=getattr(logging, log_level, logging.INFO),
+    )
 
-    elapsed = time.perf_counter() - start
-    logger.info("=== Обновление завершено ===")
-    logger.info("Добавлено/обновлено чанков: %d", total_added)
-    logger.info("Удалено чанков: %d", total_deleted_chunks)
-    logger.info("Время: %.2f сек", elapsed)
+    logger.info("=== Запуск обновления индекса ===")
+
+    kb_dir = os.path.normpath(KB_DIR)
+    if not os.path.isdir(kb_dir):
+        logger.error("Директория базы знаний не найдена: %s", kb_dir)
+        sys.exit(1)
+
+    resources = IndexResources()
+    run_update(kb_dir, resources)
+    if args.watch:
+        try:
+            watch_updates(kb_dir, resources)
+        except KeyboardInterrupt:
+            logger.info("Наблюдение остановлено")
 
 
 if __name__ == "__main__":
@@ -1,4 +1,7 @@
+import gzip
 import json
+import math
+import sys
 from collections import Counter, defaultdict
 from pathlib import Path
 
@@ -8,12 +11,16 @@ LOGS_DIR = BASE_DIR / "logs"
 REPORTS_DIR = BASE_DIR / "reports"
 BOT_LOG = BASE_DIR.parent / "5_evil_docs" / "query_logs.jsonl"
 
+sys.path.insert(0, str(BASE_DIR.parent))
+from rag_common.query_log import rotated_log_files  # noqa: E402
+
 
 def load_jsonl(path: Path):
     items = []
     if not path.exists():
         return items
-    with open(path, "r", encoding="utf-8") as f:
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rt", encoding="utf-8") as f:
         for line in f:
             line = line.strip()
             if not line:
@@ -54,17 +61,70 @@ def analyze_bot_logs(log_items: list[dict]):
     total = len(log_items)
     no_chunks = sum(1 for x in log_items if not x.get("chunks_found", False))
     unsuccessful = sum(1 for x in log_items if not x.get("successful_answer", False))
+    failed = sum(1 for x in log_items if x.get("error"))
 
     source_counter = Counter()
     for item in log_items:
         for src in item.get("sources", []):
             source_counter[src] += 1
 
+    packed = [x["context"] for x in log_items if x.get("context")]
+    tokens_saved = sum(c.get("tokens_saved", 0) for c in packed)
+    tokens_sent = sum(c.get("tokens", 0) for c in packed)
+
     return {
         "total_queries": total,
         "no_chunks_queries": no_chunks,
         "unsuccessful_answers": unsuccessful,
+        "failed_queries": failed,
         "top_sources": source_counter.most_common(10),
+        "context_tokens_saved": tokens_saved,
+        "context_tokens_saved_per_query": round(tokens_saved / len(packed), 1) if packed else 0.0,
+        "context_tokens_saved_share": round(tokens_saved / (tokens_saved + tokens_sent), 4) if packed else 0.0,
+    }
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def latency_breakdown(log_items: list[dict]):
+    """Per-stage latency from the ``trace`` field of bot logs (ms, nearest-rank percentiles)."""
+    traces = [x["trace"] for x in log_items if x.get("trace")]
+    if not traces:
+        return {"traced_queries": 0}
+
+    stages = defaultdict(list)
+    tokens = defaultdict(list)
+    pairs = Counter()
+    for trace in traces:
+        stages["total"].append(trace.get("total_ms", 0.0))
+        for name, ms in trace.get("spans_ms", {}).items():
+            stages[name].append(ms)
+        for kind, count in trace.get("tokens", {}).items():
+            tokens[kind].append(count)
+        pairs.update(trace.get("rerank_pairs", {}))
+
+    total_ms = sum(stages["total"]) or 1.0
+    breakdown = {
+        name: {
+            "count": len(values),
+            "mean_ms": round(sum(values) / len(values), 1),
+            "p50_ms": percentile(values, 0.5),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+            # Доля от суммарного времени ответов; llm_first_token входит в llm
+            "share": round(sum(values) / total_ms, 4),
+        }
+        for name, values in sorted(stages.items(), key=lambda item: -sum(item[1]))
+    }
+    return {
+        "traced_queries": len(traces),
+        "stages": breakdown,
+        "tokens_per_query": {kind: round(sum(v) / len(v), 1) for kind, v in tokens.items()},
+        # Релевантность и зонды инъекций считаются одним predict; время реранкинга делится примерно по числу пар
+        "rerank_injection_pair_share": round(pairs["injection"] / sum(pairs.values()), 4) if sum(pairs.values()) else 0.0,
     }
 
 
@@ -80,8 +140,13 @@ def main():
     else:
         summary["golden"] = {"error": "golden log not found"}
 
-    summary["bot_queries"] = analyze_bot_logs(load_jsonl(BOT_LOG))
+    # Бот ротирует лог: части query_logs-*.jsonl[.gz] читаются вместе с текущим файлом
+    bot_logs = [Path(p) for p in rotated_log_files(str(BOT_LOG))] if BOT_LOG.parent.exists() else []
+    bot_items = [item for path in bot_logs for item in load_jsonl(path)]
+    summary["bot_queries"] = analyze_bot_logs(bot_items)
+    summary["bot_queries"]["latency"] = latency_breakdown(bot_items)
     summary["bot_queries"]["log_path"] = str(BOT_LOG)
+    summary["bot_queries"]["log_files"] = len(bot_logs)
 
     report_path = REPORTS_DIR / "analytics_summary.json"
     with open(report_path, "w", encoding="utf-8") as f:
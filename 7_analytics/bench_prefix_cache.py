@@ -0,0 +1,200 @@
+"""
+Time-to-first-token benchmark for the prompt layout.
+
+Sends the golden-set questions with knowledge-base excerpts as context to an
+OpenAI-compatible /v1/chat/completions endpoint and measures the time until
+the first streamed token, for the old single-message layout (few-shot
+examples after the documents) and for the system-prefix layout of
+``rag_common.prompt.ChatPrompt``, with and without ``cache_prompt``.
+
+By default it starts a local mock server that models a llama.cpp slot: the
+prompt is prefilled at a fixed cost per token, except for the prefix it
+shares with the previous request when ``cache_prompt`` is set. With
+``--base-url`` the same requests go to a real server (llama.cpp, LM Studio).
+"""
+
+import argparse
+import http.client
+import json
+import math
+import random
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from rag_common.prompt import PROMPT_CHARS_PER_TOKEN, ChatPrompt, build_context  # noqa: E402
+
+
+BASE_DIR = Path(__file__).resolve().parent
+ROOT_DIR = BASE_DIR.parent
+GOLDEN_SET_PATH = BASE_DIR / "golden_set.json"
+KB_DIR = ROOT_DIR / "2_knowledge_base" / "knowledge_base"
+BOT_DIR = ROOT_DIR / "5_evil_docs"
+EXAMPLES_HEADING = "### Примеры общения"
+
+
+def render_prompt(messages: list[dict]) -> str:
+    # Так чат-шаблон сервера превращает сообщения в одну строку для prefill
+    return "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages)
+
+
+class MockState:
+    def __init__(self, prefill_ms: float, decode_ms: float, tokens: int):
+        self.prefill_ms = prefill_ms
+        self.decode_ms = decode_ms
+        self.tokens = tokens
+        self.cached = ""
+        self.lock = threading.Lock()
+
+
+def common_prefix(a: str, b: str) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompt = render_prompt(body["messages"])
+            with state.lock:
+                # Один слот, как у llama.cpp server с -np 1: кэш — предыдущий промпт
+                reused = common_prefix(state.cached, prompt) if body.get("cache_prompt") else 0
+                state.cached = prompt
+                new_tokens = math.ceil((len(prompt) - reused) / PROMPT_CHARS_PER_TOKEN)
+                time.sleep(new_tokens * state.prefill_ms / 1000)
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for i in range(state.tokens):
+                    if i:
+                        time.sleep(state.decode_ms / 1000)
+                    chunk = {"choices": [{"index": 0, "delta": {"content": "ток "}}]}
+                    self._write(f"data: {json.dumps(chunk)}\n\n")
+                self._write("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # Клиент закрывает соединение сразу после первого токена
+                self.close_connection = True
+
+        def _write(self, text: str):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
+
+
+def start_mock(state: MockState) -> str:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(state))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def time_to_first_token(base_url: str, model: str, messages: list[dict], cache_prompt: bool) -> float:
+    url = urlparse(base_url)
+    body = {"model": model, "messages": messages, "stream": True, "temperature": 0.0, "max_tokens": 16}
+    if cache_prompt:
+        body["cache_prompt"] = True
+    conn = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=600)
+    start = time.perf_counter()
+    conn.request(
+        "POST",
+        f"{url.path.rstrip('/')}/chat/completions",
+        body=json.dumps(body),
+        headers={"Content-Type": "application/json", "Authorization": "Bearer lm-studio"},
+    )
+    response = conn.getresponse()
+    ttft = None
+    for raw in response:
+        line = raw.decode("utf-8").strip()
+        if not line.startswith("data:") or line == "data: [DONE]":
+            continue
+        delta = json.loads(line[5:])["choices"][0].get("delta", {})
+        if delta.get("content"):
+            ttft = time.perf_counter() - start
+            break
+    conn.close()
+    if ttft is None:
+        raise RuntimeError("Сервер не вернул ни одного токена")
+    return ttft
+
+
+def legacy_messages(chat_prompt: ChatPrompt, docs: str, question: str) -> list[dict]:
+    """The pre-split single message: instructions, documents and question, then the few-shot examples."""
+    system = chat_prompt.system.render()
+    head, _, examples = system.partition(EXAMPLES_HEADING)
+    user = chat_prompt.template.render(docs=docs, user_question=question)
+    return [{"role": "user", "content": f"{head}{user}\n{EXAMPLES_HEADING}{examples}"}]
+
+
+def sample_contexts(questions: list[str], seed: int, chunk_chars: int = 300) -> list[str]:
+    rng = random.Random(seed)
+    files = sorted(KB_DIR.glob("*.md"))
+    contexts = []
+    for _ in questions:
+        chunks = []
+        for path in rng.sample(files, 5):
+            text = path.read_text(encoding="utf-8")
+            start = rng.randrange(max(1, len(text) - chunk_chars))
+            chunks.append((text[start:start + chunk_chars], path.name, rng.random()))
+        contexts.append(build_context(chunks).text)
+    return contexts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TTFT: старая раскладка промпта против system-префикса")
+    parser.add_argument("--base-url", help="OpenAI-совместимый сервер; по умолчанию — встроенный мок")
+    parser.add_argument("--model", default="local-model")
+    parser.add_argument("--rounds", type=int, default=2, help="проходов по золотому набору")
+    parser.add_argument("--prefill-ms", type=float, default=2.0, help="мок: мс на токен prefill")
+    parser.add_argument("--decode-ms", type=float, default=20.0, help="мок: мс на токен генерации")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    base_url = args.base_url or start_mock(MockState(args.prefill_ms, args.decode_ms, tokens=4))
+    with open(GOLDEN_SET_PATH, "r", encoding="utf-8") as f:
+        questions = [case["question"] for case in json.load(f)] * args.rounds
+    contexts = sample_contexts(questions, args.seed)
+
+    layouts = {
+        "legacy": lambda cp, docs, q: legacy_messages(cp, docs, q),
+        "system_prefix": lambda cp, docs, q: cp.messages(docs=docs, user_question=q),
+    }
+    chat_prompt = ChatPrompt(str(BOT_DIR / "system_prompt.txt"), str(BOT_DIR / "prompt_template.txt"))
+    report = {}
+    for name, build in layouts.items():
+        for cache_prompt in (False, True):
+            timings = [
+                time_to_first_token(base_url, args.model, build(chat_prompt, docs, question), cache_prompt)
+                for question, docs in zip(questions, contexts)
+            ]
+            # Первый запрос прогревает кэш — в статистику не входит
+            timings = timings[1:]
+            report[f"{name}{'+cache_prompt' if cache_prompt else ''}"] = {
+                "requests": len(timings),
+                "ttft_mean_ms": round(statistics.mean(timings) * 1000, 1),
+                "ttft_median_ms": round(statistics.median(timings) * 1000, 1),
+            }
+
+    print(json.dumps({"base_url": base_url, "mock": args.base_url is None, "results": report}, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,20 @@
 import json
 import os
+import sys
 from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 
 import chromadb
-from chromadb.utils import embedding_functions
 from openai import OpenAI
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from rag_common.entities import ENTITY_FAST_PATH, EntityIndex, collection_sources  # noqa: E402
+from rag_common.index_swap import read_active_collection  # noqa: E402
+from rag_common.models import INFERENCE_BACKEND, load_embedding_function  # noqa: E402
+from rag_common.prompt import ChatPrompt, build_context, llm_extra_body  # noqa: E402
+from rag_common.retrieval import entity_chunks  # noqa: E402
+
 
 BASE_DIR = Path(__file__).resolve().parent
 ROOT_DIR = BASE_DIR.parent
@@ -16,7 +23,6 @@ LOGS_DIR = BASE_DIR / "logs"
 REPORTS_DIR = BASE_DIR / "reports"
 
 CHROMA_DIR = ROOT_DIR / "3_vector_DB" / "my_vector_db"
-COLLECTION_NAME = "kb_v1"
 EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
 
 RUN_LLM = os.getenv("RUN_LLM", "0") == "1"
@@ -24,6 +30,10 @@ LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://localhost:1234/v1")
 LLM_API_KEY = os.getenv("LLM_API_KEY", "lm-studio")
 LLM_MODEL = os.getenv("LLM_MODEL", "local-model")
 N_RESULTS = int(os.getenv("N_RESULTS", "10"))
+# Те же шаблоны промпта, что и у бота, чтобы прогон проверял реальные ответы
+PROMPT_TEMPLATE_PATH = os.getenv("PROMPT_TEMPLATE", str(ROOT_DIR / "5_evil_docs" / "prompt_template.txt"))
+SYSTEM_PROMPT_PATH = os.getenv("SYSTEM_PROMPT", str(ROOT_DIR / "5_evil_docs" / "system_prompt.txt"))
+chat_prompt = ChatPrompt(SYSTEM_PROMPT_PATH, PROMPT_TEMPLATE_PATH)
 
 ABSTAIN_MARKERS = [
     "не знаю",
@@ -48,26 +58,17 @@ def is_successful_answer(answer_text: str, chunks_found: bool) -> bool:
 
 
 def compose_context(top_chunks: list[tuple[str, dict[str, Any]]]) -> str:
-    lines = []
-    for idx, (doc, meta) in enumerate(top_chunks, start=1):
-        source = meta.get("source", "unknown")
-        lines.append(f"[{idx}] Источник[{source}] Текст: {doc}")
-    return "\n\n".join(lines)
+    return build_context([(doc, meta.get("source", "unknown"), None) for doc, meta in top_chunks]).text
 
 
 def generate_answer_with_llm(question: str, top_chunks: list[tuple[str, dict[str, Any]]]) -> str:
-    context = compose_context(top_chunks)
-    prompt = (
-        "Ты RAG-ассистент. Отвечай только на основе контекста. "
-        "Если контекста недостаточно, явно напиши 'Недостаточно информации'.\n\n"
-        f"Контекст:\n{context}\n\n"
-        f"Вопрос: {question}\n"
-    )
+    messages = chat_prompt.messages(docs=compose_context(top_chunks), user_question=question)
     client = OpenAI(base_url=LLM_BASE_URL, api_key=LLM_API_KEY)
     resp = client.chat.completions.create(
         model=LLM_MODEL,
-        messages=[{"role": "user", "content": prompt}],
+        messages=messages,
         temperature=0.2,
+        extra_body=llm_extra_body(),
     )
     return resp.choices[0].message.content or ""
 
@@ -98,9 +99,10 @@ def main():
     with open(GOLDEN_SET_PATH, "r", encoding="utf-8") as f:
         golden_cases = json.load(f)
 
-    emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(model_name=EMBED_MODEL)
+    emb_fn = load_embedding_function(EMBED_MODEL)
     client = chromadb.PersistentClient(path=str(CHROMA_DIR))
-    collection = client.get_collection(name=COLLECTION_NAME, embedding_function=emb_fn)
+    collection = client.get_collection(name=read_active_collection(str(CHROMA_DIR)), embedding_function=emb_fn)
+    entity_index = EntityIndex(collection_sources(collection)) if ENTITY_FAST_PATH else None
 
     total = 0
     correct = 0
@@ -109,15 +111,24 @@ def main():
     missing_total = 0
     missing_correct = 0
     no_chunks_count = 0
+    entity_count = 0
 
     for case in golden_cases:
         total += 1
         question = case["question"]
         expected_sources = case.get("expected_sources", [])
 
-        results = collection.query(query_texts=[question], n_results=N_RESULTS)
-        docs = results.get("documents", [[]])[0]
-        metas = results.get("metadatas", [[]])[0]
+        # Вопрос о конкретном персонаже — берём чанки его файла напрямую, без поиска по сходству
+        entity_sources = entity_index.match(question) if entity_index is not None else []
+        if entity_sources:
+            entity_count += 1
+            results = entity_chunks(collection, entity_sources, N_RESULTS)
+            docs = results["documents"]
+            metas = results["metadatas"]
+        else:
+            results = collection.query(query_texts=[question], n_results=N_RESULTS)
+            docs = results.get("documents", [[]])[0]
+            metas = results.get("metadatas", [[]])[0]
 
         top_chunks: list[tuple[str, dict[str, Any]]] = []
         for doc, meta in zip(docs, metas):
@@ -162,6 +173,7 @@ def main():
             "should_answer": case["should_answer"],
             "expected_sources": expected_sources,
             "found_sources": sources,
+            "entity_sources": entity_sources,
             "chunks_found": chunks_found,
             "answer_length": len(answer_text),
             "successful_answer": is_successful_answer(answer_text, chunks_found),
@@ -183,7 +195,9 @@ def main():
         "missing_correct_rejections": missing_correct,
         "missing_rejection_rate": round(missing_correct / missing_total, 4) if missing_total else 0.0,
         "no_chunks_count": no_chunks_count,
+        "entity_fast_path_count": entity_count,
         "run_with_llm": RUN_LLM,
+        "inference_backend": INFERENCE_BACKEND,
     }
 
     with open(report_path, "w", encoding="utf-8") as f:
@@ -0,0 +1,7 @@
+"""
+Shared building blocks of the RAG pipeline.
+
+The numbered stage directories are standalone scripts; modules here are what
+the bots, the indexers and the analytics scripts have in common. Scripts put
+the repository root on ``sys.path`` before importing from this package.
+"""
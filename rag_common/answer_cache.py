@@ -0,0 +1,163 @@
+"""
+Semantic cache of final LLM answers.
+
+Questions are matched by cosine similarity of their embeddings, so a question
+asked in slightly different words reuses the stored answer and skips
+retrieval, reranking and the LLM call. Every entry remembers the chunks the
+answer cited and the MD5 of their source files as recorded in the autoupdate
+manifest; once any of those files changes, the entry is dropped.
+
+Template questions about different characters ("Кто такой X?" / "Кто такой
+Y?") embed almost identically, so an entry also remembers the entity-index
+matches of its question and is only reused for a question that names the
+same characters.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Sequence
+
+import numpy as np
+
+from rag_common.manifest import entry_md5
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+
+_CITATION_RE = re.compile(r"\[(\d+)\]")
+
+
+def cited_chunks(answer_text: str, chunk_ids: Sequence[str]) -> list[str]:
+    """Chunk ids referenced as [n] in the answer; all chunks if nothing is cited."""
+    cited = []
+    for match in _CITATION_RE.finditer(answer_text):
+        idx = int(match.group(1)) - 1
+        if 0 <= idx < len(chunk_ids) and chunk_ids[idx] not in cited:
+            cited.append(chunk_ids[idx])
+    return cited or list(chunk_ids)
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    answer: str
+    chunk_ids: list[str]
+    sources: list[str]
+    source_hashes: dict[str, Optional[str]]
+    # Источники-персонажи, названные в вопросе (EntityIndex.match), в отсортированном виде
+    entities: tuple[str, ...] = ()
+    last_used: float = field(default_factory=time.time)
+
+
+class SemanticAnswerCache:
+    def __init__(
+        self,
+        manifest_path: str,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        max_size: int = ANSWER_CACHE_SIZE,
+    ):
+        self.manifest_path = manifest_path
+        self.threshold = threshold
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries: list[CachedAnswer] = []
+        self._vectors: list[np.ndarray] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._manifest: dict = {}
+        self._manifest_mtime: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def _source_hashes(self) -> dict:
+        """File -> MD5 from the autoupdate manifest, reloaded when the file changes."""
+        try:
+            mtime = os.path.getmtime(self.manifest_path)
+        except OSError:
+            return {}
+        if mtime != self._manifest_mtime:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                self._manifest = {fname: entry_md5(entry) for fname, entry in json.load(f).items()}
+            self._manifest_mtime = mtime
+        return self._manifest
+
+    def _remove(self, idx: int) -> None:
+        del self._entries[idx]
+        del self._vectors[idx]
+        self._matrix = None
+
+    def lookup(self, embedding: Sequence[float], entities: Sequence[str] = ()) -> Optional[CachedAnswer]:
+        """Most similar fresh entry above the threshold whose question names the same ``entities``."""
+        vector = _normalize(embedding)
+        entities = tuple(sorted(entities))
+        with self._lock:
+            if self._entries:
+                if self._matrix is None:
+                    self._matrix = np.vstack(self._vectors)
+                similarities = self._matrix @ vector
+                candidates = [int(i) for i in np.argsort(-similarities) if similarities[i] >= self.threshold]
+                current = self._source_hashes() if candidates else {}
+                stale = []
+                found = None
+                for idx in candidates:
+                    entry = self._entries[idx]
+                    if not all(current.get(src) == md5 for src, md5 in entry.source_hashes.items()):
+                        # Источник ответа изменился — запись больше не актуальна
+                        stale.append(idx)
+                        continue
+                    if entry.entities == entities:
+                        found = entry
+                        break
+                for idx in sorted(stale, reverse=True):
+                    self._remove(idx)
+                if found is not None:
+                    found.last_used = time.time()
+                    self.hits += 1
+                    return found
+            self.misses += 1
+            return None
+
+    def store(
+        self,
+        question: str,
+        embedding: Sequence[float],
+        answer: str,
+        chunk_ids: Sequence[str],
+        sources: Sequence[str],
+        entities: Sequence[str] = (),
+    ) -> None:
+        with self._lock:
+            current = self._source_hashes()
+            entry = CachedAnswer(
+                question=question,
+                answer=answer,
+                chunk_ids=list(chunk_ids),
+                sources=list(sources),
+                source_hashes={src: current.get(src) for src in sources},
+                entities=tuple(sorted(entities)),
+            )
+            if len(self._entries) >= self.max_size:
+                oldest = min(range(len(self._entries)), key=lambda i: self._entries[i].last_used)
+                self._remove(oldest)
+            self._entries.append(entry)
+            self._vectors.append(_normalize(embedding))
+            self._matrix = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "size": len(self._entries),
+        }
+
+
+def _normalize(embedding: Sequence[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
@@ -0,0 +1,194 @@
+"""
+Caches for repeated questions.
+
+Three kinds of entries are cached, each in its own namespace:
+
+* ``emb``    — (embedder, query text) -> query embedding;
+* ``ids``    — (embedder, index version, query) -> retrieved chunk ids and distances;
+* ``rerank`` — (reranker, index version, query, chunk id) -> cross-encoder relevance.
+
+Model names are ``rag_common.models.model_cache_key`` values, which include
+the inference backend, so switching between torch and ONNX or changing a
+model never serves entries computed by the other one.
+
+The index version is a token that the indexers rewrite whenever they change
+the collection (see ``rag_common.retrieval``); it is part of every key that
+depends on the collection contents, so an update makes old entries
+unreachable and they are evicted by size/TTL.
+
+The in-process backend is an LRU dict. The sqlite backend keeps entries in a
+WAL-mode database file so several bot processes can share one cache.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Sequence
+
+QUERY_CACHE_BACKEND = os.getenv("QUERY_CACHE_BACKEND", "memory")  # memory | sqlite | off
+# Относительный путь считается от каталога бота (base_dir в make_query_cache), а не от текущего каталога
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", "query_cache.sqlite3")
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "10000"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "86400"))
+
+
+class MemoryCache:
+    """Thread-safe LRU cache with per-entry TTL."""
+
+    def __init__(self, max_size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict[tuple[str, str], tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get((namespace, key))
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.time():
+                del self._data[(namespace, key)]
+                return None
+            self._data.move_to_end((namespace, key))
+            return value
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[(namespace, key)] = (time.time() + self.ttl, value)
+            self._data.move_to_end((namespace, key))
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SqliteCache:
+    """LRU/TTL cache stored in a sqlite file, shared between processes."""
+
+    def __init__(self, path: str = QUERY_CACHE_PATH, max_size: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite-соединение нельзя делить между потоками пула, поэтому своё на каждый поток
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        if row[1] < now:
+            conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+            return None
+        conn.execute(
+            "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?", (now, namespace, key)
+        )
+        return json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any) -> None:
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), now + self.ttl, now),
+        )
+        # set вызывается из нескольких потоков пула — счётчик без блокировки теряет инкременты
+        with self._lock:
+            self._writes += 1
+            evict = self._writes % 100 == 0
+        if evict:
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+        conn.execute(
+            "DELETE FROM cache WHERE rowid IN ("
+            " SELECT rowid FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,),
+        )
+
+    def clear(self) -> None:
+        self._connect().execute("DELETE FROM cache")
+
+
+class QueryCache:
+    """Typed access to the three namespaces on top of a cache backend."""
+
+    def __init__(self, backend, model_name: str = "", reranker_name: str = ""):
+        self.backend = backend
+        self.model_name = model_name
+        self.reranker_name = reranker_name
+
+    def get_embedding(self, query: str) -> Optional[list[float]]:
+        return self.backend.get("emb", f"{self.model_name}\x1f{query}")
+
+    def set_embedding(self, query: str, embedding: Sequence[float]) -> None:
+        self.backend.set("emb", f"{self.model_name}\x1f{query}", [float(x) for x in embedding])
+
+    def get_retrieval(self, version: str, query: str, n_results: int) -> Optional[dict]:
+        return self.backend.get("ids", f"{self.model_name}\x1f{version}\x1f{n_results}\x1f{query}")
+
+    def set_retrieval(self, version: str, query: str, n_results: int, ids: list[str], distances: list[float]) -> None:
+        self.backend.set(
+            "ids",
+            f"{self.model_name}\x1f{version}\x1f{n_results}\x1f{query}",
+            {"ids": list(ids), "distances": [float(d) for d in distances]},
+        )
+
+    def get_scores(self, version: str, query: str, chunk_ids: Sequence[str]) -> list[Optional[float]]:
+        return [
+            self.backend.get("rerank", f"{self.reranker_name}\x1f{version}\x1f{query}\x1f{chunk_id}")
+            for chunk_id in chunk_ids
+        ]
+
+    def set_scores(self, version: str, query: str, chunk_ids: Sequence[str], scores: Sequence[float]) -> None:
+        for chunk_id, score in zip(chunk_ids, scores):
+            self.backend.set("rerank", f"{self.reranker_name}\x1f{version}\x1f{query}\x1f{chunk_id}", float(score))
+
+
+def make_query_cache(
+    model_name: str = "",
+    backend: str = QUERY_CACHE_BACKEND,
+    base_dir: Optional[str] = None,
+    reranker_name: str = "",
+) -> Optional[QueryCache]:
+    """Build the cache selected by QUERY_CACHE_BACKEND; None when caching is off.
+
+    A relative QUERY_CACHE_PATH is resolved against ``base_dir`` when it is given.
+    """
+    if backend == "off":
+        return None
+    if backend == "sqlite":
+        path = QUERY_CACHE_PATH
+        if base_dir is not None and not os.path.isabs(path):
+            path = os.path.join(base_dir, path)
+        return QueryCache(SqliteCache(path), model_name, reranker_name)
+    return QueryCache(MemoryCache(), model_name, reranker_name)
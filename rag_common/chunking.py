@@ -0,0 +1,25 @@
+"""
+Content-derived chunk ids.
+
+A chunk id is ``{filename}_{hash of the chunk text}``, so inserting a
+sentence near the top of a file does not renumber every chunk after it and
+only the chunks whose text changed have to be written to the collection.
+Repeated identical chunks within one file get a ``_{n}`` suffix.
+"""
+
+import hashlib
+from typing import Sequence
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def content_chunk_ids(filename: str, hashes: Sequence[str]) -> list[str]:
+    seen: dict[str, int] = {}
+    ids = []
+    for h in hashes:
+        n = seen.get(h, 0)
+        seen[h] = n + 1
+        ids.append(f"{filename}_{h}" if n == 0 else f"{filename}_{h}_{n}")
+    return ids
@@ -0,0 +1,120 @@
+"""
+Content-addressed cache of chunk embeddings.
+
+Embeddings are keyed by (model name, SHA-1 of the chunk text), so a chunk
+that survived an edit, a rename or a wiki refresh unchanged is never
+re-embedded. Each model gets its own directory with two append-only files:
+
+* ``vectors.f32`` — float32 matrix, one row per cached chunk, read via memmap;
+* ``keys.bin``    — 20-byte SHA-1 digests, row i of the matrix belongs to key i.
+
+Only one indexer should write to a cache directory at a time.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Sequence
+
+import numpy as np
+
+EMBED_CACHE_DIR = os.getenv(
+    "EMBED_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "3_vector_DB", "embedding_cache"),
+)
+
+_DIGEST_SIZE = 20
+
+
+def text_digest(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, model_name: str, cache_dir: str = EMBED_CACHE_DIR):
+        slug = re.sub(r"[^\w.-]+", "_", model_name).strip("_")
+        self.dir = os.path.join(cache_dir, slug)
+        os.makedirs(self.dir, exist_ok=True)
+        self.model_name = model_name
+        self._vectors_path = os.path.join(self.dir, "vectors.f32")
+        self._keys_path = os.path.join(self.dir, "keys.bin")
+        self._meta_path = os.path.join(self.dir, "meta.json")
+        self._lock = threading.Lock()
+        self._matrix = None
+        self.hits = 0
+        self.misses = 0
+
+        self.dim = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+
+        self._index: dict[bytes, int] = {}
+        self._rows = 0
+        if self.dim and os.path.exists(self._keys_path) and os.path.exists(self._vectors_path):
+            with open(self._keys_path, "rb") as f:
+                keys = f.read()
+            # После аварийной записи файлы могут разойтись — берём только полные строки
+            rows = min(len(keys) // _DIGEST_SIZE, os.path.getsize(self._vectors_path) // (4 * self.dim))
+            for row in range(rows):
+                self._index[keys[row * _DIGEST_SIZE:(row + 1) * _DIGEST_SIZE]] = row
+            self._rows = rows
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _read(self, row: int) -> list[float]:
+        if self._matrix is None or self._matrix.shape[0] < self._rows:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(self._rows, self.dim))
+        return self._matrix[row].tolist()
+
+    def _append(self, digests: list[bytes], vectors: np.ndarray) -> None:
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            with open(self._meta_path, "w", encoding="utf-8") as f:
+                json.dump({"model": self.model_name, "dim": self.dim}, f)
+            # Файлы могли остаться от прерванной записи без meta.json
+            for path in (self._vectors_path, self._keys_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        # Сначала векторы, потом ключи: ключ без вектора при загрузке отбрасывается
+        with open(self._vectors_path, "r+b" if os.path.exists(self._vectors_path) else "wb") as f:
+            f.seek(self._rows * 4 * self.dim)
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            f.truncate()
+        with open(self._keys_path, "r+b" if os.path.exists(self._keys_path) else "wb") as f:
+            f.seek(self._rows * _DIGEST_SIZE)
+            f.write(b"".join(digests))
+            f.truncate()
+        for i, digest in enumerate(digests):
+            self._index[digest] = self._rows + i
+        self._rows += len(digests)
+        self._matrix = None
+
+    def embed(self, texts: Sequence[str], emb_fn) -> list[list[float]]:
+        """Embeddings for ``texts``; only texts missing from the cache go to ``emb_fn``."""
+        with self._lock:
+            digests = [text_digest(text) for text in texts]
+            result: list = [None] * len(texts)
+            missing: dict[bytes, list[int]] = {}
+            for i, digest in enumerate(digests):
+                row = self._index.get(digest)
+                if row is None:
+                    missing.setdefault(digest, []).append(i)
+                else:
+                    result[i] = self._read(row)
+            self.hits += len(texts) - sum(len(positions) for positions in missing.values())
+            self.misses += sum(len(positions) for positions in missing.values())
+
+            if missing:
+                new_digests = list(missing)
+                new_vectors = np.asarray(
+                    emb_fn([texts[missing[digest][0]] for digest in new_digests]), dtype=np.float32
+                )
+                self._append(new_digests, new_vectors)
+                for digest, vector in zip(new_digests, new_vectors.tolist()):
+                    for i in missing[digest]:
+                        result[i] = vector
+            return result
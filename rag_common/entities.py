@@ -0,0 +1,133 @@
+"""
+Character-name fast path.
+
+Every knowledge-base file is named after a character, so a query that
+mentions a name can go straight to that file's chunks instead of a
+similarity search. Names and queries are normalized with the BM25 analyzer
+(case, "ё"/"е", Snowball stemming, so "Уззелла" matches "Уззелл"), and all
+names are matched in one pass over the query tokens by an Aho–Corasick
+automaton.
+"""
+
+import os
+import re
+import threading
+from collections import deque
+from typing import Iterator, Optional, Sequence
+
+from rag_common.lexical import analyze
+
+ENTITY_FAST_PATH = os.getenv("ENTITY_FAST_PATH", "1") == "1"
+
+_QUALIFIER_RE = re.compile(r"\s*\([^)]*\)")
+
+
+class AhoCorasick:
+    """Multi-pattern matcher over token sequences."""
+
+    def __init__(self):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._out: list[list[tuple[int, object]]] = [[]]
+
+    def add(self, tokens: Sequence[str], value) -> None:
+        node = 0
+        for token in tokens:
+            child = self._goto[node].get(token)
+            if child is None:
+                child = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+                self._goto[node][token] = child
+            node = child
+        self._out[node].append((len(tokens), value))
+
+    def build(self) -> None:
+        """Compute failure links; call once after all patterns are added."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for token, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and token not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(token, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] = self._out[child] + self._out[self._fail[child]]
+
+    def find(self, tokens: Sequence[str]) -> Iterator[tuple[int, int, object]]:
+        """(start, end, value) for every pattern occurrence in ``tokens``."""
+        node = 0
+        for i, token in enumerate(tokens):
+            while node and token not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(token, 0)
+            for length, value in self._out[node]:
+                yield i - length + 1, i + 1, value
+
+
+class EntityIndex:
+    def __init__(self, sources: Sequence[str]):
+        patterns: dict[tuple, set] = {}
+        for source in sources:
+            title = os.path.splitext(source)[0]
+            # «Борис (медведь)» и «Борис (тролль)» находятся и по общему «Борис», и по полному названию
+            for name in {_QUALIFIER_RE.sub("", title), title}:
+                tokens = tuple(analyze(name))
+                # Однословные короткие имена слишком часто совпадают со случайными словами
+                if not tokens or (len(tokens) == 1 and len(tokens[0]) < 3):
+                    continue
+                patterns.setdefault(tokens, set()).add(source)
+
+        self._automaton = AhoCorasick()
+        for tokens, names in patterns.items():
+            self._automaton.add(tokens, tuple(sorted(names)))
+        self._automaton.build()
+        self.size = len(patterns)
+
+    def match(self, query: str) -> list[str]:
+        """Sources whose names occur in the query; longest matches win where they overlap."""
+        tokens = analyze(query)
+        matches = sorted(self._automaton.find(tokens), key=lambda m: (m[0] - m[1], m[0]))
+        taken = [False] * len(tokens)
+        found = []
+        for start, end, sources in matches:
+            if any(taken[start:end]):
+                continue
+            taken[start:end] = [True] * (end - start)
+            found.append((start, sources))
+        result = []
+        for _, sources in sorted(found, key=lambda f: f[0]):
+            result.extend(source for source in sources if source not in result)
+        return result
+
+
+def collection_sources(collection, batch_size: int = 5000) -> list[str]:
+    sources = set()
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+        if not page["ids"]:
+            break
+        sources.update((meta or {}).get("source") for meta in page["metadatas"])
+        offset += len(page["ids"])
+    sources.discard(None)
+    return sorted(sources)
+
+
+class ActiveEntityIndex:
+    """Name index of the collection the bot currently reads, rebuilt once per ``ActiveCollection`` version."""
+
+    def __init__(self):
+        self._version: Optional[str] = None
+        self._index: Optional[EntityIndex] = None
+        self._lock = threading.Lock()
+
+    def get(self, collection, version: str) -> EntityIndex:
+        with self._lock:
+            if version != self._version:
+                self._index = EntityIndex(collection_sources(collection))
+                self._version = version
+            return self._index
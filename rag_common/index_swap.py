@@ -0,0 +1,347 @@
+"""
+Blue/green switching of the Chroma collection the bots read.
+
+Indexers never modify the collection the bots are reading: they write into
+another versioned collection (``kb_v1_<timestamp>_<suffix>``), smoke-test
+it on the golden set and then atomically rewrite the pointer file
+``active_collection`` next to the Chroma files.
+
+Incremental indexers keep retired versions as standbys instead of copying
+the whole active collection on every update. Their writes go through
+``RecordingCollection``; after the switch ``standby.json`` lists, for every
+kept version, the ids of the chunks in which it differs from the new active
+one. The next update copies those chunks (with their vectors) from the
+active collection onto a drained standby, which makes the two equal, and
+applies its own changes on top. A full copy (``clone_collection``) is made
+only when there is no drained standby: on the first update, after a full
+rebuild, after an update that failed halfway, or when the last switch was
+less than ``COLLECTION_GRACE_SECONDS`` ago. Bots re-check the pointer on
+every request (one stat call) and reopen the collection whenever it was
+rewritten, even if the name is one they have read before; requests that
+already hold the old handle finish on it. A replaced version
+is recorded in ``retired_collections.json`` with the time of the switch and
+is deleted only once it is surplus to ``KEEP_COLLECTIONS`` and has been
+retired for at least ``COLLECTION_GRACE_SECONDS``, so in-flight requests
+drain before their collection disappears.
+"""
+
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Iterable, Optional
+
+from rag_common.journal import write_json_atomic
+
+BASE_COLLECTION = "kb_v1"
+ACTIVE_COLLECTION_FILE = "active_collection"
+# Сколько версий коллекции хранить: активную и предыдущую, на которой дорабатывают старые запросы
+KEEP_COLLECTIONS = int(os.getenv("KEEP_COLLECTIONS", "2"))
+# Сколько секунд снятая с активных версия ещё не удаляется: запросы бота, успевшие её открыть, дорабатывают
+COLLECTION_GRACE_SECONDS = float(os.getenv("COLLECTION_GRACE_SECONDS", "60"))
+RETIRED_COLLECTIONS_FILE = "retired_collections.json"
+STANDBY_FILE = "standby.json"
+
+GOLDEN_SET_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "7_analytics", "golden_set.json"
+)
+# Допустимое падение доли вопросов золотого набора, для которых найден ожидаемый источник
+SMOKE_TOLERANCE = float(os.getenv("SMOKE_TOLERANCE", "0.05"))
+SMOKE_N_RESULTS = 10
+
+
+def read_active_collection(db_dir: str) -> str:
+    """Name of the collection the bots should read; the base name for indexes built before the switch."""
+    try:
+        with open(os.path.join(db_dir, ACTIVE_COLLECTION_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or BASE_COLLECTION
+    except FileNotFoundError:
+        return BASE_COLLECTION
+
+
+def new_collection_name() -> str:
+    # Имена сортируются по времени создания — по ним же выбираются версии на удаление
+    return f"{BASE_COLLECTION}_{time.strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}"
+
+
+def collection_names(client) -> list[str]:
+    # В разных версиях Chroma list_collections возвращает имена или объекты коллекций
+    return [c if isinstance(c, str) else c.name for c in client.list_collections()]
+
+
+def clone_collection(client, source_name: str, target_name: str, emb_fn, batch_size: int):
+    """New collection with the documents, metadata and embeddings of ``source_name``; nothing is re-embedded."""
+    target = client.create_collection(name=target_name, embedding_function=emb_fn)
+    if source_name not in collection_names(client):
+        return target
+
+    source = client.get_collection(name=source_name, embedding_function=emb_fn)
+    offset = 0
+    while True:
+        page = source.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+        if not len(page["ids"]):
+            break
+        target.add(
+            ids=page["ids"],
+            documents=page["documents"],
+            metadatas=page["metadatas"],
+            embeddings=page["embeddings"],
+        )
+        offset += len(page["ids"])
+    return target
+
+
+def _golden_recall(collection, query_embeddings, expected: list[set], n_results: int) -> float:
+    results = collection.query(query_embeddings=query_embeddings, n_results=n_results, include=["metadatas"])
+    hits = sum(
+        1
+        for metas, sources in zip(results["metadatas"], expected)
+        if any((meta or {}).get("source") in sources for meta in metas)
+    )
+    return hits / len(expected)
+
+
+def smoke_check(client, collection, emb_fn, db_dir: str, golden_path: str = GOLDEN_SET_PATH,
+                tolerance: float = SMOKE_TOLERANCE) -> Optional[float]:
+    """Golden-set smoke pass before a switch; raises RuntimeError if the new collection is worse.
+
+    The new collection must not be empty, and the share of answerable golden
+    questions whose expected source is retrieved must not drop by more than
+    ``tolerance`` against the active collection. Returns that share, or None
+    if there is no golden set.
+    """
+    if collection.count() == 0:
+        raise RuntimeError(f"Коллекция {collection.name} пуста")
+
+    if not os.path.exists(golden_path):
+        return None
+    with open(golden_path, "r", encoding="utf-8") as f:
+        cases = [case for case in json.load(f) if case.get("should_answer") and case.get("expected_sources")]
+    if not cases:
+        return None
+
+    query_embeddings = emb_fn([case["question"] for case in cases])
+    expected = [set(case["expected_sources"]) for case in cases]
+    recall = _golden_recall(collection, query_embeddings, expected, SMOKE_N_RESULTS)
+
+    active = read_active_collection(db_dir)
+    if active != collection.name and active in collection_names(client):
+        baseline = _golden_recall(
+            client.get_collection(name=active, embedding_function=emb_fn), query_embeddings, expected, SMOKE_N_RESULTS
+        )
+        if recall < baseline - tolerance:
+            raise RuntimeError(
+                f"Коллекция {collection.name} хуже активной {active} на золотом наборе: {recall:.2f} < {baseline:.2f}"
+            )
+    return recall
+
+
+def read_retired(db_dir: str) -> dict[str, float]:
+    """Collection name -> time it stopped being active."""
+    try:
+        with open(os.path.join(db_dir, RETIRED_COLLECTIONS_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def activate_collection(
+    client,
+    db_dir: str,
+    name: str,
+    keep: int = KEEP_COLLECTIONS,
+    grace: float = COLLECTION_GRACE_SECONDS,
+    protect: Iterable[str] = (),
+) -> list[str]:
+    """Point the bots at ``name`` and drop drained versions older than the ``keep`` newest.
+
+    A version is dropped only after it has been retired for ``grace``
+    seconds; surplus versions still draining are dropped by a later switch.
+    ``protect`` names versions that must be kept regardless. Returns dropped names.
+    """
+    previous_active = read_active_collection(db_dir)
+    path = os.path.join(db_dir, ACTIVE_COLLECTION_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(name)
+    os.replace(tmp_path, path)
+
+    now = time.time()
+    retired = read_retired(db_dir)
+    retired.pop(name, None)
+    if previous_active != name:
+        retired[previous_active] = now
+
+    versions = sorted(
+        n for n in collection_names(client) if n == BASE_COLLECTION or n.startswith(f"{BASE_COLLECTION}_")
+    )
+    protected = set(protect)
+    # Запасная версия снова становится активной, поэтому порядок имён не совпадает с возрастом версий:
+    # лишними считаются давно снятые; версии без отметки о снятии (созданные до отложенного удаления) — самые старые
+    previous = sorted(
+        (n for n in versions if n != name),
+        key=lambda n: (n in protected, retired.get(n, 0.0), n),
+    )
+    surplus = previous[:max(0, len(previous) - (keep - 1))]
+    dropped = [n for n in surplus if n not in protected and now - retired.get(n, 0.0) >= grace]
+    for old_name in dropped:
+        client.delete_collection(name=old_name)
+    write_json_atomic(
+        os.path.join(db_dir, RETIRED_COLLECTIONS_FILE),
+        {n: t for n, t in retired.items() if n in versions and n not in dropped},
+    )
+    return dropped
+
+
+class RecordingCollection:
+    """Chroma collection wrapper that remembers the ids of every chunk written or deleted."""
+
+    def __init__(self, collection):
+        self._collection = collection
+        self.ids: set[str] = set()
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _record(self, kwargs: dict) -> None:
+        self.ids.update(kwargs["ids"])
+
+    def add(self, **kwargs):
+        self._collection.add(**kwargs)
+        self._record(kwargs)
+
+    def upsert(self, **kwargs):
+        self._collection.upsert(**kwargs)
+        self._record(kwargs)
+
+    def update(self, **kwargs):
+        self._collection.update(**kwargs)
+        self._record(kwargs)
+
+    def delete(self, **kwargs):
+        self._collection.delete(**kwargs)
+        self._record(kwargs)
+
+
+def sync_chunks(source, target, ids: list[str], batch_size: int) -> None:
+    """Make ``target`` hold the same ``ids`` as ``source``: copy existing chunks with their vectors, delete the rest."""
+    for i in range(0, len(ids), batch_size):
+        batch = ids[i:i + batch_size]
+        page = source.get(ids=batch, include=["documents", "metadatas", "embeddings"])
+        if len(page["ids"]):
+            target.upsert(
+                ids=page["ids"],
+                documents=page["documents"],
+                metadatas=page["metadatas"],
+                embeddings=page["embeddings"],
+            )
+        missing = sorted(set(batch) - set(page["ids"]))
+        if missing:
+            target.delete(ids=missing)
+
+
+def read_standby(db_dir: str) -> dict:
+    """{"base": active collection, "pending": {standby name: ids that differ from it}}."""
+    try:
+        with open(os.path.join(db_dir, STANDBY_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def open_standby(client, db_dir: str, emb_fn, batch_size: int, grace: float = COLLECTION_GRACE_SECONDS):
+    """Collection to write the next version into, with the active collection's contents.
+
+    Returns a ``RecordingCollection`` and a dict describing how it was
+    prepared: ``mode`` ("replay" or "clone") and ``replayed`` (chunks copied
+    from the active collection onto the standby). A standby retired less
+    than ``grace`` seconds ago may still be read by the bots, so it is not
+    waited for: the active collection is cloned instead.
+    """
+    active = read_active_collection(db_dir)
+    state = read_standby(db_dir)
+    pending = state.get("pending", {}) if state.get("base") == active else {}
+    names = collection_names(client)
+    retired = read_retired(db_dir)
+    now = time.time()
+    drained = [
+        name for name in pending
+        if name != active and name in names and now - retired.get(name, 0.0) >= grace
+    ]
+    if not drained:
+        target = clone_collection(client, active, new_collection_name(), emb_fn, batch_size)
+        return RecordingCollection(target), {"mode": "clone", "replayed": 0}
+
+    name = min(drained, key=lambda n: len(pending[n]))
+    # Запасная версия сейчас начнёт меняться: если процесс упадёт, её состояние неизвестно и она не годится
+    write_json_atomic(
+        os.path.join(db_dir, STANDBY_FILE),
+        {"base": active, "pending": {n: ids for n, ids in pending.items() if n != name}},
+    )
+    standby = client.get_collection(name=name, embedding_function=emb_fn)
+    source = client.get_collection(name=active, embedding_function=emb_fn)
+    sync_chunks(source, standby, pending[name], batch_size)
+    return RecordingCollection(standby), {"mode": "replay", "replayed": len(pending[name])}
+
+
+def activate_standby(client, db_dir: str, collection: RecordingCollection) -> list[str]:
+    """Switch to ``collection`` and keep the retired versions as standbys for later updates."""
+    previous = read_active_collection(db_dir)
+    state = read_standby(db_dir)
+    pending = state.get("pending", {}) if state.get("base") == previous else {}
+    # Каждая запасная версия отличается от новой активной своими чанками плюс чанками этого обновления
+    pending = {
+        name: sorted(set(ids) | collection.ids) for name, ids in pending.items() if name != collection.name
+    }
+    if previous != collection.name:
+        pending[previous] = sorted(collection.ids)
+    dropped = activate_collection(client, db_dir, collection.name, protect=[previous])
+    names = collection_names(client)
+    write_json_atomic(
+        os.path.join(db_dir, STANDBY_FILE),
+        {"base": collection.name, "pending": {n: ids for n, ids in pending.items() if n in names}},
+    )
+    return dropped
+
+
+class ActiveCollection:
+    """Handle of the collection named by the pointer file, reopened after every switch.
+
+    Incremental updates write into retired versions and switch back to them,
+    so a name seen before does not mean unchanged contents: the handle and
+    everything cached for it are keyed by the pointer's mtime (``version``).
+    Chroma keeps a collection's vector segment in memory once opened, so
+    when a name comes back the client is recreated by ``open_client``.
+    """
+
+    def __init__(self, client, db_dir: str, emb_fn, open_client=None):
+        self.client = client
+        self.db_dir = db_dir
+        self.emb_fn = emb_fn
+        self.open_client = open_client
+        self.name: Optional[str] = None
+        self.version: Optional[str] = None
+        self._collection = None
+        self._opened: set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self):
+        """(collection, name, version) to use for one request."""
+        try:
+            version = str(os.stat(os.path.join(self.db_dir, ACTIVE_COLLECTION_FILE)).st_mtime_ns)
+        except FileNotFoundError:
+            version = "0"
+        with self._lock:
+            if self._collection is None or version != self.version:
+                name = read_active_collection(self.db_dir)
+                if name in self._opened and self.open_client is not None:
+                    # Версию меняли другие процессы — её сегмент в памяти клиента устарел
+                    self.client.clear_system_cache()
+                    self.client = self.open_client()
+                    self._opened.clear()
+                self._collection = self.client.get_collection(name=name, embedding_function=self.emb_fn)
+                self._opened.add(name)
+                self.name = name
+                self.version = version
+            return self._collection, self.name, self.version
@@ -0,0 +1,37 @@
+"""
+Bounded worker pool for blocking model calls.
+
+Chroma queries (which embed the question), cross-encoder scoring and other
+CPU-bound work must not run on the asyncio event loop of the Telegram bot,
+otherwise one slow request freezes every other chat.
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, TypeVar
+
+T = TypeVar("T")
+
+# Сколько потоков одновременно гоняют модели (torch/onnx отпускают GIL).
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "2"))
+# Сколько запросов пользователей бот обрабатывает параллельно.
+MAX_CONCURRENT_QUERIES = int(os.getenv("MAX_CONCURRENT_QUERIES", "16"))
+
+
+class InferencePool:
+    """Runs blocking callables in a fixed-size thread pool from async code."""
+
+    def __init__(self, workers: int = INFERENCE_WORKERS):
+        self.workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="inference"
+        )
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
@@ -0,0 +1,83 @@
+"""
+Write-ahead journal for incremental index updates.
+
+Before touching the collection the updater records which files it is about
+to change; once the changes are applied it appends the new manifest entries
+of those files. Records are JSON lines, fsync-ed on write. If the process
+dies mid-update, ``recover`` folds the journal into the manifest: files that
+were finished get their new entry, files that were started but not finished
+are marked as unknown so the next scan resyncs them from the collection.
+"""
+
+import json
+import os
+from typing import Optional
+
+# Запись манифеста для файла в неизвестном состоянии: MD5 не совпадёт ни с чем,
+# а без списка чанков старые чанки ищутся в коллекции по source
+UNKNOWN_ENTRY = {"md5": None}
+
+
+def write_json_atomic(path: str, data) -> None:
+    """Write JSON via a temp file and rename, so readers never see a half-written file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class UpdateJournal:
+    def __init__(self, path: str):
+        self.path = path
+
+    def begin(self, files: dict[str, str]) -> None:
+        """Start an update of ``files`` (name -> "sync" | "delete")."""
+        self.clear()
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"begin": files}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def done(self, entries: dict[str, Optional[dict]]) -> None:
+        """The files are applied; values are their new manifest entries, None for deleted files."""
+        with open(self.path, "a", encoding="utf-8") as f:
+            for filename, entry in entries.items():
+                f.write(json.dumps({"file": filename, "entry": entry}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def read(self) -> list[dict]:
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Оборванная последняя строка: процесс упал во время записи
+                    break
+        return records
+
+    def recover(self, manifest: dict) -> Optional[dict]:
+        """Manifest with an interrupted update folded in, or None if there is nothing to recover."""
+        records = self.read()
+        if not records or "begin" not in records[0]:
+            return None
+
+        done = {record["file"]: record["entry"] for record in records[1:] if "file" in record}
+        manifest = dict(manifest)
+        for filename in records[0]["begin"]:
+            if filename not in done:
+                manifest[filename] = dict(UNKNOWN_ENTRY)
+            elif done[filename] is None:
+                manifest.pop(filename, None)
+            else:
+                manifest[filename] = done[filename]
+        return manifest
@@ -0,0 +1,115 @@
+"""
+Lazily constructed heavy resources and a startup-time report.
+
+Models, the Chroma client and similar objects are wrapped in ``Lazy`` so a
+process starts in well under a second: nothing heavy is imported or built
+until the first request needs it. ``warm_up`` optionally builds them in a
+background thread right after start, so the first user does not pay for
+it either. Every construction is timed into a ``StartupReport``, which
+shows where the startup time goes, component by component.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Generic, Iterable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Прогрев моделей в фоне сразу после старта (WARM_UP=0 — только по первому запросу)
+WARM_UP = os.getenv("WARM_UP", "1") == "1"
+
+logger = logging.getLogger(__name__)
+
+
+class StartupReport:
+    """Seconds spent initializing each component, in the order they finished."""
+
+    def __init__(self, started: Optional[float] = None):
+        # started — time.perf_counter() в самом начале процесса, до тяжёлых импортов
+        self.started = time.perf_counter() if started is None else started
+        self._timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, component: str, seconds: float) -> None:
+        with self._lock:
+            self._timings[component] = seconds
+
+    @contextmanager
+    def measure(self, component: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(component, time.perf_counter() - start)
+
+    def as_dict(self) -> dict[str, float]:
+        with self._lock:
+            return {component: round(seconds, 3) for component, seconds in self._timings.items()}
+
+    def summary(self) -> str:
+        parts = [f"{component}={seconds:.2f}с" for component, seconds in self.as_dict().items()]
+        return ", ".join(parts) or "нет данных"
+
+
+class Lazy(Generic[T]):
+    """Value built by ``factory`` on the first ``get()``; concurrent callers wait for one build."""
+
+    def __init__(self, name: str, factory: Callable[[], T], report: Optional[StartupReport] = None):
+        self.name = name
+        self._factory = factory
+        self._report = report
+        self._value: Optional[T] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self) -> T:
+        if self._loaded:
+            return self._value  # type: ignore[return-value]
+        with self._lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                self._value = self._factory()
+                self._loaded = True
+                seconds = time.perf_counter() - start
+                if self._report is not None:
+                    self._report.record(self.name, seconds)
+                logger.info("Загружено %s за %.2f с", self.name, seconds)
+        return self._value  # type: ignore[return-value]
+
+
+def warm_up(
+    resources: Iterable[Lazy],
+    report: Optional[StartupReport] = None,
+    background: bool = True,
+) -> Optional[threading.Thread]:
+    """Build ``resources`` in order, in a daemon thread unless ``background`` is False."""
+    resources = list(resources)
+
+    def run():
+        for resource in resources:
+            try:
+                resource.get()
+            except Exception:
+                # Ошибка повторится при первом запросе и попадёт к пользователю обычным путём
+                logger.exception("Не удалось прогреть %s", resource.name)
+                return
+        if report is not None:
+            logger.info(
+                "Прогрев завершён за %.2f с после старта: %s",
+                time.perf_counter() - report.started,
+                report.summary(),
+            )
+
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,184 @@
+"""
+In-process BM25 index over chunk text.
+
+Dense MiniLM retrieval often misses rare proper names ("Тим Уззелл"), which
+are exactly what golden-set questions ask about. The lexical index catches
+them: words are lowercased, "ё" is folded into "е", stop words are dropped
+and the rest is Snowball-stemmed (Russian for Cyrillic words, English for
+Latin ones). Its hits are fused with vector hits in
+``rag_common.retrieval.retrieve``.
+
+The index is stored per collection version as
+``<db_dir>/bm25/<collection name>.json`` and written by the indexers next to
+the collection they build.
+"""
+
+import heapq
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+from typing import Iterable, Optional, Sequence
+
+import snowballstemmer
+
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+# Сколько кандидатов берётся из каждого списка (вектора и BM25) перед слиянием
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))
+LEXICAL_INDEX_DIR = "bm25"
+
+_WORD_RE = re.compile(r"\w+")
+_CYRILLIC_RE = re.compile("[а-я]")
+
+STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было "
+    "вот от меня еще нет о из ему теперь когда даже ну ли если уже или ни быть был него до вас нибудь "
+    "опять уж вам ведь там потом себя ей может они тут где есть надо ней для мы тебя их чем была сам "
+    "без чего раз тоже себе под будет ж тогда кто этот того потому этого какой такой такая такое "
+    "ним здесь этом один мой тем чтобы нее были куда зачем всех можно при об хоть после над больше тот "
+    "через эти нас про всего них какая много три эту моя свою этой перед том им более между "
+    "the a an of and or in on to is are was were for with by at from as"
+    .split()
+)
+
+_stemmers = {
+    "russian": snowballstemmer.stemmer("russian"),
+    "english": snowballstemmer.stemmer("english"),
+}
+# Стеммеры Snowball хранят состояние внутри объекта — из потоков пула вызываем их по очереди
+_stem_lock = threading.Lock()
+
+
+@lru_cache(maxsize=200_000)
+def stem(word: str) -> str:
+    language = "russian" if _CYRILLIC_RE.search(word) else "english"
+    with _stem_lock:
+        return _stemmers[language].stemWord(word)
+
+
+def analyze(text: str) -> list[str]:
+    """Index terms of ``text``: lowercased, stop words removed, stemmed."""
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [stem(word) for word in words if word not in STOP_WORDS and (len(word) > 1 or word.isdigit())]
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: dict[str, dict[str, int]] = {}
+        self._lengths: dict[str, int] = {}
+        self._postings: dict[str, dict[str, int]] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    def _index(self, chunk_id: str, freqs: dict[str, int]) -> None:
+        self._docs[chunk_id] = freqs
+        length = sum(freqs.values())
+        self._lengths[chunk_id] = length
+        self._total_length += length
+        for term, tf in freqs.items():
+            self._postings.setdefault(term, {})[chunk_id] = tf
+
+    def add(self, ids: Sequence[str], texts: Sequence[str]) -> None:
+        self.remove(chunk_id for chunk_id in ids if chunk_id in self._docs)
+        for chunk_id, text in zip(ids, texts):
+            self._index(chunk_id, dict(Counter(analyze(text or ""))))
+
+    def remove(self, ids: Iterable[str]) -> None:
+        for chunk_id in list(ids):
+            freqs = self._docs.pop(chunk_id, None)
+            if freqs is None:
+                continue
+            self._total_length -= self._lengths.pop(chunk_id)
+            for term in freqs:
+                posting = self._postings[term]
+                del posting[chunk_id]
+                if not posting:
+                    del self._postings[term]
+
+    def search(self, query: str, n_results: int) -> list[tuple[str, float]]:
+        """Top ``n_results`` chunk ids with their BM25 scores."""
+        if not self._docs:
+            return []
+        n_docs = len(self._docs)
+        avg_length = self._total_length / n_docs or 1.0
+        scores: dict[str, float] = {}
+        for term in set(analyze(query)):
+            posting = self._postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(n_results, scores.items(), key=lambda item: item[1])
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "docs": self._docs}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        for chunk_id, freqs in data["docs"].items():
+            index._index(chunk_id, freqs)
+        return index
+
+    @classmethod
+    def from_collection(cls, collection, batch_size: int = 5000) -> "BM25Index":
+        index = cls()
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=batch_size, offset=offset)
+            if not page["ids"]:
+                break
+            index.add(page["ids"], page["documents"])
+            offset += len(page["ids"])
+        return index
+
+
+def lexical_index_path(db_dir: str, collection_name: str) -> str:
+    return os.path.join(db_dir, LEXICAL_INDEX_DIR, f"{collection_name}.json")
+
+
+def load_lexical_index(db_dir: str, collection, collection_name: Optional[str] = None) -> BM25Index:
+    """Stored index of a collection version; built from the collection if the indexer did not write one."""
+    path = lexical_index_path(db_dir, collection_name or collection.name)
+    if os.path.exists(path):
+        return BM25Index.load(path)
+    return BM25Index.from_collection(collection)
+
+
+def drop_lexical_indexes(db_dir: str, collection_names: Iterable[str]) -> None:
+    for name in collection_names:
+        path = lexical_index_path(db_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ActiveLexicalIndex:
+    """BM25 index of the collection the bot currently reads, loaded once per ``ActiveCollection`` version."""
+
+    def __init__(self, db_dir: str):
+        self.db_dir = db_dir
+        self._version: Optional[str] = None
+        self._index: Optional[BM25Index] = None
+        self._lock = threading.Lock()
+
+    def get(self, collection, collection_name: str, version: str) -> BM25Index:
+        with self._lock:
+            if version != self._version:
+                self._index = load_lexical_index(self.db_dir, collection, collection_name)
+                self._version = version
+            return self._index
@@ -0,0 +1,37 @@
+"""
+Entries of the autoupdate manifest (``6_autoupdate/.manifest.json``).
+
+An entry is ``{"md5": ..., "size": ..., "mtime_ns": ..., "chunks": [chunk hash, ...]}``;
+size and mtime let the scanner skip hashing files that were not touched.
+Manifests written before chunk-level updates store just the MD5 string.
+"""
+
+from typing import Optional, Union
+
+ManifestEntry = Union[str, dict]
+
+
+def entry_md5(entry: Optional[ManifestEntry]) -> Optional[str]:
+    if entry is None or isinstance(entry, str):
+        return entry
+    return entry.get("md5")
+
+
+def entry_chunks(entry: Optional[ManifestEntry]) -> Optional[list[str]]:
+    """Chunk hashes of the indexed version of a file, or None if unknown."""
+    if isinstance(entry, dict):
+        return entry.get("chunks")
+    return None
+
+
+def entry_stat(entry: Optional[ManifestEntry]) -> Optional[tuple[int, int]]:
+    """(size, mtime_ns) of the file when the entry was written, or None if not recorded."""
+    if isinstance(entry, dict) and "size" in entry and "mtime_ns" in entry:
+        return entry["size"], entry["mtime_ns"]
+    return None
+
+
+def with_stat(entry: ManifestEntry, info: Optional[dict]) -> dict:
+    """Entry of an unchanged file updated with its current size/mtime."""
+    base = {"md5": entry} if isinstance(entry, str) else dict(entry)
+    return {**base, **(info or {})}
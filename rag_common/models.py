@@ -0,0 +1,256 @@
+"""
+Inference backends for the embedding model and the cross-encoder.
+
+``INFERENCE_BACKEND=torch`` (the default) loads the full-precision PyTorch
+models exactly as before. ``INFERENCE_BACKEND=onnx`` loads ONNX exports of
+the same models through onnxruntime; ``ONNX_QUANTIZATION`` picks the int8
+dynamically quantized variant (``avx2``, ``avx512``, ``avx512_vnni``,
+``arm64``) or ``none`` for the fp32 export. The exports are written by
+``3_vector_DB/export_onnx.py`` into ``ONNX_MODELS_DIR``, which also checks
+their outputs against PyTorch. ``INFERENCE_THREADS`` caps the intra-op
+threads of either runtime (0 keeps the runtime default). ONNX models always
+run on the CPU; PyTorch picks CUDA/MPS when available unless
+``INFERENCE_DEVICE`` names a device.
+
+torch, sentence-transformers, chromadb and onnxruntime are imported inside
+the loaders, so importing this module costs nothing until a model is built.
+"""
+
+import os
+from functools import lru_cache
+from typing import TYPE_CHECKING, Sequence
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from sentence_transformers import CrossEncoder, SentenceTransformer
+
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "0"))
+# Устройство для PyTorch (cpu, cuda, mps); пусто — sentence-transformers выбирает сам
+INFERENCE_DEVICE = os.getenv("INFERENCE_DEVICE") or None
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx2")
+ONNX_MODELS_DIR = os.getenv(
+    "ONNX_MODELS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "models", "onnx")
+)
+
+# Пороги сверки ONNX с PyTorch: косинус эмбеддингов и расхождение оценок cross-encoder'а.
+# Расхождение должно быть намного меньше порога опасности INJECTION_THRESHOLD (0.035), иначе фильтр инъекций поплывёт
+PARITY_MIN_COSINE = float(os.getenv("PARITY_MIN_COSINE", "0.98"))
+PARITY_MAX_SCORE_DIFF = float(os.getenv("PARITY_MAX_SCORE_DIFF", "0.005"))
+
+BACKENDS = ("torch", "onnx")
+
+
+def onnx_model_dir(model_name: str) -> str:
+    """Directory with the ONNX export of ``model_name`` (a hub id or a local path)."""
+    return os.path.join(ONNX_MODELS_DIR, os.path.basename(os.path.normpath(model_name)))
+
+
+def onnx_file_name(quantization: str = ONNX_QUANTIZATION) -> str:
+    if quantization in ("", "none"):
+        return "onnx/model.onnx"
+    return f"onnx/model_qint8_{quantization}.onnx"
+
+
+def model_cache_key(model_name: str, backend: str = INFERENCE_BACKEND) -> str:
+    """Model id for embedding and query caches: int8 vectors must not mix with fp32 ones."""
+    if backend == "torch":
+        return model_name
+    return f"{model_name}@{backend}:{onnx_file_name()}"
+
+
+def _check_backend(backend: str) -> None:
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный INFERENCE_BACKEND={backend!r}, допустимо: {', '.join(BACKENDS)}")
+
+
+def _onnx_model_kwargs(quantization: str, threads: int) -> dict:
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise RuntimeError("INFERENCE_BACKEND=onnx требует пакет onnxruntime") from e
+
+    session_options = onnxruntime.SessionOptions()
+    if threads > 0:
+        session_options.intra_op_num_threads = threads
+    return {
+        "file_name": onnx_file_name(quantization),
+        "provider": "CPUExecutionProvider",
+        "session_options": session_options,
+    }
+
+
+def _onnx_path(model_name: str, quantization: str) -> str:
+    path = onnx_model_dir(model_name)
+    if not os.path.exists(os.path.join(path, onnx_file_name(quantization))):
+        raise FileNotFoundError(
+            f"Нет ONNX-модели {os.path.join(path, onnx_file_name(quantization))}, "
+            "сначала запустите 3_vector_DB/export_onnx.py"
+        )
+    return path
+
+
+def _set_torch_threads(threads: int) -> None:
+    if threads > 0:
+        import torch
+
+        torch.set_num_threads(threads)
+
+
+@lru_cache(maxsize=None)
+def _onnx_embedding_function_class():
+    # Класс наследуется от EmbeddingFunction Chroma, поэтому создаётся при первой загрузке, а не при импорте
+    from chromadb import Documents, EmbeddingFunction, Embeddings
+
+    class OnnxEmbeddingFunction(EmbeddingFunction[Documents]):
+        """Chroma embedding function over a sentence-transformers model running in onnxruntime."""
+
+        def __init__(self, model: "SentenceTransformer"):
+            self.model = model
+
+        def __call__(self, input: Documents) -> Embeddings:
+            embeddings = self.model.encode(list(input), convert_to_numpy=True)
+            return [np.asarray(e, dtype=np.float32) for e in embeddings]
+
+    return OnnxEmbeddingFunction
+
+
+def load_sentence_transformer(
+    model_name: str,
+    backend: str = INFERENCE_BACKEND,
+    quantization: str = ONNX_QUANTIZATION,
+    threads: int = INFERENCE_THREADS,
+) -> "SentenceTransformer":
+    from sentence_transformers import SentenceTransformer
+
+    _check_backend(backend)
+    if backend == "onnx":
+        return SentenceTransformer(
+            _onnx_path(model_name, quantization),
+            device="cpu",
+            backend="onnx",
+            model_kwargs=_onnx_model_kwargs(quantization, threads),
+        )
+    _set_torch_threads(threads)
+    return SentenceTransformer(model_name, device=INFERENCE_DEVICE)
+
+
+def load_embedding_function(
+    model_name: str,
+    backend: str = INFERENCE_BACKEND,
+    quantization: str = ONNX_QUANTIZATION,
+    threads: int = INFERENCE_THREADS,
+):
+    """Embedding function for Chroma collections on the configured backend."""
+    _check_backend(backend)
+    if backend == "onnx":
+        return _onnx_embedding_function_class()(load_sentence_transformer(model_name, backend, quantization, threads))
+    from chromadb.utils import embedding_functions
+
+    _set_torch_threads(threads)
+    if INFERENCE_DEVICE is not None:
+        return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name, device=INFERENCE_DEVICE)
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
+
+
+def load_reranker(
+    model_name: str,
+    backend: str = INFERENCE_BACKEND,
+    quantization: str = ONNX_QUANTIZATION,
+    threads: int = INFERENCE_THREADS,
+) -> "CrossEncoder":
+    from sentence_transformers import CrossEncoder
+
+    _check_backend(backend)
+    if backend == "onnx":
+        return CrossEncoder(
+            _onnx_path(model_name, quantization),
+            device="cpu",
+            backend="onnx",
+            model_kwargs=_onnx_model_kwargs(quantization, threads),
+        )
+    _set_torch_threads(threads)
+    return CrossEncoder(model_name, device=INFERENCE_DEVICE)
+
+
+def export_onnx(model_name: str, cross_encoder: bool = False, quantization: str = ONNX_QUANTIZATION) -> str:
+    """Export ``model_name`` to ONNX (and its int8 variant) under ONNX_MODELS_DIR. Returns the directory."""
+    from sentence_transformers import CrossEncoder, SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    path = onnx_model_dir(model_name)
+    model_cls = CrossEncoder if cross_encoder else SentenceTransformer
+    # Без готового onnx/model.onnx sentence-transformers экспортирует модель сам
+    model = model_cls(model_name, device="cpu", backend="onnx")
+    model.save_pretrained(path)
+    if quantization not in ("", "none"):
+        export_dynamic_quantized_onnx_model(model, quantization, path)
+    return path
+
+
+def _cosines(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def embedding_parity(
+    model_name: str, texts: Sequence[str], quantization: str = ONNX_QUANTIZATION
+) -> dict:
+    """Cosine between PyTorch and ONNX embeddings of ``texts``."""
+    reference = load_sentence_transformer(model_name, "torch").encode(list(texts), convert_to_numpy=True)
+    candidate = load_sentence_transformer(model_name, "onnx", quantization).encode(list(texts), convert_to_numpy=True)
+    cosines = _cosines(np.asarray(reference, dtype=np.float32), np.asarray(candidate, dtype=np.float32))
+    min_cosine = float(cosines.min())
+    return {
+        "texts": len(texts),
+        "min_cosine": round(min_cosine, 4),
+        "mean_cosine": round(float(cosines.mean()), 4),
+        "ok": min_cosine >= PARITY_MIN_COSINE,
+    }
+
+
+def reranker_parity(
+    model_name: str,
+    queries: Sequence[tuple[str, Sequence[str]]],
+    quantization: str = ONNX_QUANTIZATION,
+    top_k: int = 5,
+    probes: Sequence[str] = (),
+    injection_threshold: float = 0.0,
+) -> dict:
+    """Agreement of the PyTorch and ONNX cross-encoders over (query, documents) pairs.
+
+    Compares scores and top-k for the queries and, for every (probe, document)
+    pair, whether the score reaches ``injection_threshold``: a backend that
+    flips injection decisions fails even if its scores are close.
+    """
+    reference_model = load_reranker(model_name, "torch")
+    candidate_model = load_reranker(model_name, "onnx", quantization)
+    max_diff = 0.0
+    same_top = 0
+    n_pairs = 0
+    flipped = 0
+    for query, documents in queries:
+        pairs = [[query, doc] for doc in documents]
+        reference = np.asarray(reference_model.predict(pairs), dtype=np.float32)
+        candidate = np.asarray(candidate_model.predict(pairs), dtype=np.float32)
+        max_diff = max(max_diff, float(np.abs(reference - candidate).max()))
+        k = min(top_k, len(documents))
+        same_top += set(np.argsort(-reference)[:k].tolist()) == set(np.argsort(-candidate)[:k].tolist())
+        n_pairs += len(pairs)
+
+        probe_pairs = [[probe, doc] for probe in probes for doc in documents]
+        if probe_pairs:
+            reference = np.asarray(reference_model.predict(probe_pairs), dtype=np.float32)
+            candidate = np.asarray(candidate_model.predict(probe_pairs), dtype=np.float32)
+            max_diff = max(max_diff, float(np.abs(reference - candidate).max()))
+            flipped += int(np.sum((reference >= injection_threshold) != (candidate >= injection_threshold)))
+            n_pairs += len(probe_pairs)
+    return {
+        "queries": len(queries),
+        "pairs": n_pairs,
+        "max_score_diff": round(max_diff, 4),
+        "same_top_k": same_top,
+        "injection_flips": flipped,
+        "ok": max_diff <= PARITY_MAX_SCORE_DIFF and same_top == len(queries) and flipped == 0,
+    }
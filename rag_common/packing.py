@@ -0,0 +1,142 @@
+"""
+Context packing between reranking and prompt rendering.
+
+The chunker overlaps neighbouring chunks of a file, so the top chunks of a
+query often repeat the same sentences. ``pack_chunks`` takes the reranked
+chunks in rank order, greedily keeps those that fit the token budget and
+merges chunks of the same source with consecutive ``chunk_id`` into one
+span, dropping the text the later chunk repeats from the earlier one. Each
+span becomes one numbered document in the prompt; the tokens saved against
+sending the same chunks one by one are reported for the query log.
+"""
+
+import os
+from typing import NamedTuple, Optional, Sequence
+
+from rag_common.prompt import (
+    PROMPT_CHARS_PER_TOKEN,
+    PROMPT_CONTEXT_TOKENS,
+    PROMPT_MAX_DOCS,
+    doc_header,
+    estimate_tokens,
+)
+
+PACK_CONTEXT = os.getenv("PACK_CONTEXT", "1") == "1"
+# Совпадение короче этого считается случайным и не вырезается
+MIN_OVERLAP_CHARS = 8
+
+
+class ContextSpan(NamedTuple):
+    source: str
+    text: str
+    ids: list[str]
+    relevance: Optional[float]
+
+
+class PackedContext(NamedTuple):
+    spans: list[ContextSpan]
+    chunks: int
+    # Оценка токенов контекста из тех же чанков без склейки и после неё
+    tokens_before: int
+    tokens_after: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.tokens_before - self.tokens_after)
+
+    def stats(self) -> dict:
+        return {
+            "chunks": self.chunks,
+            "spans": len(self.spans),
+            "tokens": self.tokens_after,
+            "tokens_saved": self.tokens_saved,
+        }
+
+
+def strip_overlap(previous: str, text: str) -> str:
+    """``text`` without its longest prefix that is also a suffix of ``previous``."""
+    limit = min(len(previous), len(text))
+    for start in range(len(previous) - limit, len(previous) - MIN_OVERLAP_CHARS + 1):
+        if text.startswith(previous[start:]):
+            return text[len(previous) - start:]
+    return text
+
+
+def _position(meta: dict) -> Optional[int]:
+    position = (meta or {}).get("chunk_id")
+    return position if isinstance(position, int) else None
+
+
+def _spans(selected: list[tuple[int, str, str, dict, Optional[float]]]) -> list[ContextSpan]:
+    """Merge runs of consecutive chunks of one source; spans are ordered by their best-ranked chunk."""
+    by_source: dict[tuple, list] = {}
+    for item in selected:
+        _, chunk_id, _, meta, _ = item
+        source = (meta or {}).get("source", "unknown")
+        position = _position(meta)
+        # Чанки без номера позиции не склеиваются ни с чем
+        key = (source,) if position is not None else (source, chunk_id)
+        by_source.setdefault(key, []).append((position if position is not None else 0, item))
+
+    ranked_spans = []
+    for key, items in by_source.items():
+        items.sort(key=lambda p: p[0])
+        run: list = []
+        for position, item in items:
+            if run and position != run[-1][0] + 1:
+                ranked_spans.append(_merge(key[0], run))
+                run = []
+            run.append((position, item))
+        ranked_spans.append(_merge(key[0], run))
+    ranked_spans.sort(key=lambda s: s[0])
+    return [span for _, span in ranked_spans]
+
+
+def _merge(source: str, run: list) -> tuple[int, ContextSpan]:
+    items = [item for _, item in run]
+    text = items[0][2]
+    for previous, item in zip(items, items[1:]):
+        rest = strip_overlap(previous[2], item[2])
+        # Без найденного перекрытия соседние чанки просто разделяются пробелом
+        text = text + rest if len(rest) < len(item[2]) else f"{text} {rest}"
+    relevances = [item[4] for item in items if item[4] is not None]
+    span = ContextSpan(
+        source=source,
+        text=text,
+        ids=[item[1] for item in items],
+        relevance=max(relevances) if relevances else None,
+    )
+    return min(item[0] for item in items), span
+
+
+def _tokens(spans: Sequence[ContextSpan], chars_per_token: float) -> int:
+    return sum(
+        estimate_tokens(doc_header(i, span.source, span.relevance) + span.text, chars_per_token)
+        for i, span in enumerate(spans, start=1)
+    )
+
+
+def pack_chunks(
+    chunks: Sequence[tuple[str, str, dict, Optional[float]]],
+    token_budget: int = PROMPT_CONTEXT_TOKENS,
+    max_chunks: int = PROMPT_MAX_DOCS,
+    chars_per_token: float = PROMPT_CHARS_PER_TOKEN,
+) -> PackedContext:
+    """Pack (chunk_id, text, metadata, relevance) given in rank order into at most ``max_chunks`` chunks."""
+    selected: list = []
+    spans: list[ContextSpan] = []
+    for rank, (chunk_id, text, meta, relevance) in enumerate(chunks):
+        if len(selected) >= max_chunks:
+            break
+        trial = selected + [(rank, chunk_id, text, meta, relevance)]
+        trial_spans = _spans(trial)
+        # Первый чанк берётся всегда, дальше — только если склейка укладывается в бюджет
+        if selected and _tokens(trial_spans, chars_per_token) > token_budget:
+            continue
+        selected, spans = trial, trial_spans
+
+    unpacked = [
+        ContextSpan((meta or {}).get("source", "unknown"), text, [chunk_id], relevance)
+        for _, chunk_id, text, meta, relevance in selected
+    ]
+    return PackedContext(spans, len(selected), _tokens(unpacked, chars_per_token), _tokens(spans, chars_per_token))
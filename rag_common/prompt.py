@@ -0,0 +1,158 @@
+"""
+Prompt assembly for the RAG bots and the golden-set runner.
+
+``PromptTemplate`` reads ``prompt_template.txt`` once, splits it into literal
+text and ``{{placeholders}}`` and re-reads it only when the file's mtime
+changes, so the template can be edited without restarting the bot. The
+prompt is rendered in a single join, so a question that happens to contain
+``{{docs}}`` is never substituted again.
+
+The document block is capped at ``PROMPT_CONTEXT_TOKENS``: chunks are added
+in rank order until the budget is spent, and the chunk that crosses it is
+cut at a word boundary. Tokens are estimated from the character count
+(``PROMPT_CHARS_PER_TOKEN``) because the local LLM's tokenizer is not
+available to the bot.
+
+``ChatPrompt`` pairs the template with a static ``system_prompt.txt`` (role,
+instructions, few-shot examples) that is sent first, as a system message,
+so every request starts with the same bytes and the LLM server can reuse
+its KV cache for that prefix; only the documents and the question are
+processed per request. ``LLM_CACHE_PROMPT=1`` additionally asks
+llama.cpp-compatible servers to keep the prompt cache (``cache_prompt``).
+"""
+
+import math
+import os
+import re
+import threading
+from typing import NamedTuple, Optional, Sequence
+
+# Бюджет контекста в токенах: длинные чанки не должны раздувать prefill LLM
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "1500"))
+PROMPT_CHARS_PER_TOKEN = float(os.getenv("PROMPT_CHARS_PER_TOKEN", "3.0"))
+# Сколько документов максимум попадает в промпт
+PROMPT_MAX_DOCS = int(os.getenv("PROMPT_MAX_DOCS", "5"))
+# Обрезанный хвост короче этого не добавляется — сборка контекста на этом заканчивается
+MIN_CHUNK_TOKENS = 32
+# Статическая часть промпта уходит отдельным system-сообщением (0 — склеивается с вопросом в одно сообщение)
+PROMPT_SYSTEM_MESSAGE = os.getenv("PROMPT_SYSTEM_MESSAGE", "1") == "1"
+# Поле cache_prompt в запросе: llama.cpp server переиспользует KV-кэш общего префикса
+LLM_CACHE_PROMPT = os.getenv("LLM_CACHE_PROMPT", "0") == "1"
+
+_PLACEHOLDER_RE = re.compile(r"\{\{(\w+)\}\}")
+
+
+def estimate_tokens(text: str, chars_per_token: float = PROMPT_CHARS_PER_TOKEN) -> int:
+    return math.ceil(len(text) / chars_per_token)
+
+
+def _truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    space = cut.rfind(" ")
+    if space > max_chars // 2:
+        cut = cut[:space]
+    return cut.rstrip() + "…"
+
+
+def doc_header(number: int, source: str, relevance: Optional[float] = None) -> str:
+    header = f"[{number}] Источник[{source}] "
+    if relevance is not None:
+        header += f"Релевантность: {relevance:.4f} | "
+    return header + "Текст: "
+
+
+class ContextBlock(NamedTuple):
+    text: str
+    # Сколько первых чанков попало в промпт: номера [n] в ответе ссылаются на них
+    count: int
+    tokens: int
+    truncated: bool
+
+
+def build_context(
+    chunks: Sequence[tuple[str, str, Optional[float]]],
+    token_budget: int = PROMPT_CONTEXT_TOKENS,
+    max_docs: int = PROMPT_MAX_DOCS,
+    chars_per_token: float = PROMPT_CHARS_PER_TOKEN,
+) -> ContextBlock:
+    """Numbered document block from (text, source, relevance) in rank order; relevance may be None."""
+    parts = []
+    tokens = 0
+    truncated = False
+    for i, (text, source, relevance) in enumerate(chunks[:max_docs], start=1):
+        header = doc_header(i, source, relevance)
+        remaining = token_budget - tokens - estimate_tokens(header, chars_per_token)
+        text_tokens = estimate_tokens(text, chars_per_token)
+        if text_tokens > remaining:
+            if parts and remaining < MIN_CHUNK_TOKENS:
+                truncated = True
+                break
+            # Первый документ попадает в промпт всегда, хотя бы обрезанным
+            text = _truncate(text, int(max(remaining, MIN_CHUNK_TOKENS) * chars_per_token))
+            truncated = True
+        part = header + text
+        parts.append(part)
+        tokens += estimate_tokens(part, chars_per_token)
+        if truncated:
+            break
+    return ContextBlock("\n\n".join(parts), len(parts), tokens, truncated)
+
+
+class PromptTemplate:
+    """Template with ``{{name}}`` placeholders, re-read when the file changes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._segments: list[tuple[bool, str]] = []
+        self._mtime: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _compile(self, text: str) -> list[tuple[bool, str]]:
+        # (True, имя) — подстановка, (False, текст) — текст шаблона как есть
+        segments = []
+        pos = 0
+        for match in _PLACEHOLDER_RE.finditer(text):
+            if match.start() > pos:
+                segments.append((False, text[pos:match.start()]))
+            segments.append((True, match.group(1)))
+            pos = match.end()
+        if pos < len(text):
+            segments.append((False, text[pos:]))
+        return segments
+
+    def segments(self) -> list[tuple[bool, str]]:
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._segments = self._compile(f.read())
+                self._mtime = mtime
+            return self._segments
+
+    def render(self, **values: str) -> str:
+        """Template with placeholders replaced in one pass; unknown placeholders are left empty."""
+        return "".join(values.get(value, "") if is_field else value for is_field, value in self.segments())
+
+
+class ChatPrompt:
+    """Chat messages with the static system prompt first and the per-request template last."""
+
+    def __init__(self, system_path: str, template_path: str, system_message: bool = PROMPT_SYSTEM_MESSAGE):
+        self.system = PromptTemplate(system_path)
+        self.template = PromptTemplate(template_path)
+        self.system_message = system_message
+
+    def messages(self, **values: str) -> list[dict]:
+        system = self.system.render()
+        user = self.template.render(**values)
+        if self.system_message:
+            return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+        # Одно сообщение, но статическая часть всё равно идёт первой и остаётся общим префиксом
+        return [{"role": "user", "content": f"{system}\n{user}"}]
+
+
+def llm_extra_body(cache_prompt: bool = LLM_CACHE_PROMPT) -> Optional[dict]:
+    """``extra_body`` for chat.completions.create: server-side prompt caching where it is supported."""
+    return {"cache_prompt": True} if cache_prompt else None
@@ -0,0 +1,197 @@
+"""
+Background writer for the bot's query log.
+
+``QueryLogWriter.write`` only puts the event into a bounded queue, so the
+async handler never waits for the disk. A daemon thread appends queued
+events in batches: as soon as ``QUERY_LOG_BATCH`` events are waiting, or
+``QUERY_LOG_FLUSH_SECONDS`` after the first of them. Each batch is one
+append under an advisory lock on ``<log>.lock``, so several bot processes
+can share one file.
+
+Before appending, the file is rotated to ``query_logs-<UTC time>.jsonl``
+when it has grown past ``QUERY_LOG_ROTATE_MB`` or was last written in an
+earlier ``QUERY_LOG_ROTATE_HOURS`` period; with ``QUERY_LOG_COMPRESS=1``
+rotated files are gzip-compressed. ``close`` writes out everything still
+queued; it is also registered with ``atexit``.
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Сколько событий ждут записи; при переполнении новые отбрасываются, а не тормозят ответ
+QUERY_LOG_QUEUE = int(os.getenv("QUERY_LOG_QUEUE", "10000"))
+QUERY_LOG_BATCH = int(os.getenv("QUERY_LOG_BATCH", "100"))
+QUERY_LOG_FLUSH_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "1.0"))
+# Ротация по размеру и по времени (0 — выключена)
+QUERY_LOG_ROTATE_MB = float(os.getenv("QUERY_LOG_ROTATE_MB", "50"))
+QUERY_LOG_ROTATE_HOURS = float(os.getenv("QUERY_LOG_ROTATE_HOURS", "24"))
+QUERY_LOG_COMPRESS = os.getenv("QUERY_LOG_COMPRESS", "0") == "1"
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def rotated_log_files(path: str) -> list[str]:
+    """Rotated parts of the log at ``path``, oldest first, followed by ``path`` itself if it exists."""
+    directory = os.path.dirname(path) or "."
+    base, ext = os.path.splitext(os.path.basename(path))
+    prefix = f"{base}-"
+    parts = sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and (name.endswith(ext) or name.endswith(f"{ext}.gz"))
+    )
+    if os.path.exists(path):
+        parts.append(path)
+    return parts
+
+
+class QueryLogWriter:
+    """JSON-lines log appended in batches by a background thread."""
+
+    def __init__(
+        self,
+        path: str,
+        max_queue: int = QUERY_LOG_QUEUE,
+        batch_size: int = QUERY_LOG_BATCH,
+        flush_seconds: float = QUERY_LOG_FLUSH_SECONDS,
+        rotate_mb: float = QUERY_LOG_ROTATE_MB,
+        rotate_hours: float = QUERY_LOG_ROTATE_HOURS,
+        compress: bool = QUERY_LOG_COMPRESS,
+    ):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.rotate_bytes = int(rotate_mb * 1024 * 1024)
+        self.rotate_seconds = rotate_hours * 3600
+        self.compress = compress
+        self.written = 0
+        self.dropped = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=max(1, max_queue))
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="query-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, event: dict) -> None:
+        """Queue ``event`` without blocking; after ``close`` it is written synchronously."""
+        if self._closed:
+            self._append([event])
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Очередь лога запросов переполнена, отброшено событий: %d", self.dropped)
+
+    def stats(self) -> dict:
+        return {"written": self.written, "dropped": self.dropped, "queued": self._queue.qsize()}
+
+    def close(self, timeout: float = 10.0) -> None:
+        """Write out the queued events and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning("Лог запросов не успел записаться: в очереди %d событий", self._queue.qsize())
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("Лог запросов не успел записаться: в очереди %d событий", self._queue.qsize())
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_seconds
+            while batch[-1] is not _STOP and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is _STOP
+            events = batch[:-1] if stop else batch
+            if events:
+                try:
+                    self._append(events)
+                except Exception:
+                    logger.exception("Не удалось записать %d событий в %s", len(events), self.path)
+            if stop:
+                return
+
+    def _append(self, events: list[dict]) -> None:
+        data = "".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events).encode("utf-8")
+        with self._file_lock():
+            rotated = self._rotate()
+            with open(self.path, "ab") as f:
+                f.write(data)
+        self.written += len(events)
+        if rotated and self.compress:
+            # Сжатие — вне блокировки, чтобы не задерживать запись другим процессам
+            self._compress(rotated)
+
+    def _rotate(self) -> Optional[str]:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size == 0:
+            return None
+        by_size = self.rotate_bytes > 0 and stat.st_size >= self.rotate_bytes
+        # Периоды отсчитываются от эпохи, а не от запуска — все процессы ротируют на одной границе
+        by_time = self.rotate_seconds > 0 and (
+            int(stat.st_mtime // self.rotate_seconds) != int(time.time() // self.rotate_seconds)
+        )
+        if not (by_size or by_time):
+            return None
+        base, ext = os.path.splitext(self.path)
+        rotated = f"{base}-{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}{ext}"
+        os.replace(self.path, rotated)
+        return rotated
+
+    def _compress(self, path: str) -> None:
+        tmp_path = f"{path}.gz.tmp"
+        try:
+            with open(path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(tmp_path, f"{path}.gz")
+            os.remove(path)
+        except OSError:
+            logger.exception("Не удалось сжать %s", path)
+
+    @contextmanager
+    def _file_lock(self):
+        with open(f"{self.path}.lock", "a+b") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            else:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+                else:
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
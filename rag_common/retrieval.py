@@ -0,0 +1,172 @@
+"""
+Vector retrieval with caching.
+
+``retrieve`` returns a flat result (one query) and goes to Chroma only when
+the cache has no entry for the current index version. The version token is
+stored next to the Chroma files and rewritten by the indexers after every
+change of the collection. Given a BM25 index, ``retrieve`` fuses its hits
+with the vector hits by reciprocal rank fusion. ``entity_chunks`` is the
+fast path for queries that name a character: it reads that file's chunks
+by a metadata filter instead of searching.
+"""
+
+import os
+import uuid
+from typing import Optional, Sequence
+
+from rag_common.cache import QueryCache
+from rag_common.lexical import HYBRID_CANDIDATES, BM25Index
+
+INDEX_VERSION_FILE = "index_version"
+RRF_K = 60
+
+
+def read_index_version(db_dir: str) -> str:
+    try:
+        with open(os.path.join(db_dir, INDEX_VERSION_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or "0"
+    except FileNotFoundError:
+        return "0"
+
+
+def bump_index_version(db_dir: str) -> str:
+    """Write a new version token; caches keyed by the old one stop matching."""
+    version = uuid.uuid4().hex[:12]
+    path = os.path.join(db_dir, INDEX_VERSION_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp_path, path)
+    return version
+
+
+def embed_query(emb_fn, query: str, cache: Optional[QueryCache] = None) -> list[float]:
+    embedding = cache.get_embedding(query) if cache is not None else None
+    if embedding is None:
+        embedding = [float(x) for x in emb_fn([query])[0]]
+        if cache is not None:
+            cache.set_embedding(query, embedding)
+    return embedding
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> list[tuple[str, float]]:
+    """Ids from several rankings ordered by the sum of ``1 / (k + rank)``."""
+    scores: dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def retrieve(
+    collection,
+    emb_fn,
+    query: str,
+    n_results: int,
+    cache: Optional[QueryCache] = None,
+    version: str = "0",
+    embedding: Optional[Sequence[float]] = None,
+    lexical: Optional[BM25Index] = None,
+) -> dict:
+    """Nearest chunks for one query as ``{"ids", "documents", "metadatas", "distances"}``.
+
+    With ``lexical`` the result is the RRF fusion of the vector and BM25
+    candidate lists; ``distances`` then holds the fused scores.
+    """
+    if lexical is not None:
+        # Гибридный и чисто векторный результаты кэшируются раздельно
+        version = f"{version}:rrf"
+    if cache is not None:
+        hit = cache.get_retrieval(version, query, n_results)
+        if hit is not None:
+            got = collection.get(ids=hit["ids"], include=["documents", "metadatas"])
+            by_id = {
+                chunk_id: (doc, meta)
+                for chunk_id, doc, meta in zip(got["ids"], got["documents"], got["metadatas"])
+            }
+            if all(chunk_id in by_id for chunk_id in hit["ids"]):
+                return {
+                    "ids": hit["ids"],
+                    "documents": [by_id[chunk_id][0] for chunk_id in hit["ids"]],
+                    "metadatas": [by_id[chunk_id][1] for chunk_id in hit["ids"]],
+                    "distances": hit["distances"],
+                }
+
+    if embedding is None:
+        embedding = embed_query(emb_fn, query, cache)
+
+    if lexical is None:
+        results = collection.query(query_embeddings=[list(embedding)], n_results=n_results)
+        flat = {
+            "ids": results["ids"][0],
+            "documents": results["documents"][0],
+            "metadatas": results["metadatas"][0],
+            "distances": results["distances"][0],
+        }
+    else:
+        flat = _hybrid(collection, embedding, query, n_results, lexical)
+    if cache is not None:
+        cache.set_retrieval(version, query, n_results, flat["ids"], flat["distances"])
+    return flat
+
+
+def _hybrid(collection, embedding: Sequence[float], query: str, n_results: int, lexical: BM25Index) -> dict:
+    n_candidates = max(n_results, HYBRID_CANDIDATES)
+    results = collection.query(query_embeddings=[list(embedding)], n_results=n_candidates)
+    found = {
+        chunk_id: (doc, meta)
+        for chunk_id, doc, meta in zip(results["ids"][0], results["documents"][0], results["metadatas"][0])
+    }
+    lexical_ids = [chunk_id for chunk_id, _ in lexical.search(query, n_candidates)]
+    fused = reciprocal_rank_fusion([results["ids"][0], lexical_ids])[:n_results]
+
+    # Чанки, найденные только BM25, дочитываем из коллекции одним запросом
+    missing = [chunk_id for chunk_id, _ in fused if chunk_id not in found]
+    if missing:
+        got = collection.get(ids=missing, include=["documents", "metadatas"])
+        found.update(
+            (chunk_id, (doc, meta)) for chunk_id, doc, meta in zip(got["ids"], got["documents"], got["metadatas"])
+        )
+    # BM25-индекс мог отстать от коллекции — такие id пропускаем
+    fused = [(chunk_id, score) for chunk_id, score in fused if chunk_id in found]
+    return {
+        "ids": [chunk_id for chunk_id, _ in fused],
+        "documents": [found[chunk_id][0] for chunk_id, _ in fused],
+        "metadatas": [found[chunk_id][1] for chunk_id, _ in fused],
+        "distances": [score for _, score in fused],
+    }
+
+
+def source_filter(sources: Sequence[str]) -> dict:
+    return {"source": sources[0]} if len(sources) == 1 else {"source": {"$in": list(sources)}}
+
+
+def entity_chunks(collection, sources: Sequence[str], n_results: int, embedding: Optional[Sequence[float]] = None) -> dict:
+    """Chunks of the named source files, in the same shape as ``retrieve``.
+
+    If the files have more than ``n_results`` chunks, the nearest ones to
+    ``embedding`` are taken when it is known, otherwise the first ones (the
+    introduction of a wiki page).
+    """
+    where = source_filter(sources)
+    got = collection.get(where=where, include=["documents", "metadatas"])
+    if len(got["ids"]) > n_results and embedding is not None:
+        results = collection.query(query_embeddings=[list(embedding)], n_results=n_results, where=where)
+        return {
+            "ids": results["ids"][0],
+            "documents": results["documents"][0],
+            "metadatas": results["metadatas"][0],
+            "distances": results["distances"][0],
+        }
+
+    order = {source: i for i, source in enumerate(sources)}
+    chunks = sorted(
+        zip(got["ids"], got["documents"], got["metadatas"]),
+        key=lambda c: (order.get((c[2] or {}).get("source"), len(order)), (c[2] or {}).get("chunk_id", 0)),
+    )[:n_results]
+    return {
+        "ids": [chunk_id for chunk_id, _, _ in chunks],
+        "documents": [doc for _, doc, _ in chunks],
+        "metadatas": [meta for _, _, meta in chunks],
+        "distances": [None] * len(chunks),
+    }
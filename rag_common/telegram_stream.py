@@ -0,0 +1,101 @@
+"""
+Progressive delivery of a streamed LLM answer to Telegram.
+
+The answer is shown as soon as the first tokens arrive and then grows by
+editing the same message. Edits are throttled (Telegram allows roughly one
+edit per second per chat) and text longer than one Telegram message
+continues in follow-up messages.
+"""
+
+import asyncio
+import os
+import time
+from typing import AsyncIterator
+
+from telegram.error import BadRequest, RetryAfter
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Ответ, если модель не вернула ничего, кроме пробелов
+EMPTY_ANSWER_TEXT = "Модель не вернула ответа, попробуйте переформулировать вопрос."
+# Дописывается к уже показанной части ответа, если генерация оборвалась
+STREAM_ERROR_MARKER = "\n\n⚠️ Ответ оборвался из-за ошибки."
+
+
+async def iter_deltas(stream) -> AsyncIterator[str]:
+    """Text deltas from an OpenAI-compatible ``stream=True`` completion.
+
+    The final chunk requested by ``stream_options={"include_usage": True}``
+    has no choices and only carries ``usage``; it is skipped here and its
+    token counts are recorded by ``tracing.traced_stream``.
+    """
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+
+def _split(text: str) -> list[str]:
+    return [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)]
+
+
+async def _render(message, sent: list, text: str, final: bool) -> None:
+    """Bring the sent messages in line with ``text``; ``sent`` holds [message, shown_text] pairs."""
+    for i, part in enumerate(_split(text)):
+        while True:
+            try:
+                if i < len(sent):
+                    if sent[i][1] != part:
+                        await sent[i][0].edit_text(part)
+                        sent[i][1] = part
+                else:
+                    sent.append([await message.reply_text(part), part])
+                break
+            except RetryAfter as e:
+                # Промежуточные правки можно пропустить, финальную — дождаться
+                if not final:
+                    return
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                await asyncio.sleep(float(retry_after))
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                sent[i][1] = part
+                break
+
+
+async def stream_reply(message, deltas: AsyncIterator[str], edit_interval: float = STREAM_EDIT_INTERVAL) -> str:
+    """Show the answer in Telegram while it is generated; returns the full text.
+
+    An empty answer is replaced by ``EMPTY_ANSWER_TEXT``; if the stream fails,
+    the part already shown is marked as cut off and the error is re-raised.
+    """
+    text = ""
+    sent: list = []
+    last_edit = 0.0
+    try:
+        async for delta in deltas:
+            text += delta
+            now = time.monotonic()
+            if text.strip() and now - last_edit >= edit_interval:
+                await _render(message, sent, text, final=False)
+                last_edit = now
+    except Exception:
+        try:
+            if sent:
+                await _render(message, sent, text + STREAM_ERROR_MARKER, final=True)
+            else:
+                await message.reply_text(STREAM_ERROR_MARKER.strip())
+        except Exception:
+            # Исходная ошибка важнее — её и пробрасываем
+            pass
+        raise
+    if text.strip():
+        await _render(message, sent, text, final=True)
+    else:
+        await message.reply_text(EMPTY_ANSWER_TEXT)
+    return text
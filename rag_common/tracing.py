@@ -0,0 +1,209 @@
+"""
+Per-stage latency of a bot query.
+
+A ``QueryTrace`` is created for every question. The handler wraps each
+pipeline stage (embedding, search, cross-encoder, LLM call and so on) in
+``trace.span(name)`` and adds token counts and model names. ``finish``
+returns the trace for the query log and adds the span durations to
+``LatencyHistograms``. Those are Prometheus-style cumulative buckets, from
+which p50/p95/p99 are interpolated the same way ``histogram_quantile``
+does. ``start_metrics_server`` serves them in the Prometheus text format
+when ``METRICS_PORT`` is set.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import AsyncIterator, Optional
+
+# Порт эндпоинта /metrics (0 — выключен); слушает только локальный адрес
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Границы бакетов в секундах: от поиска в Chroma до долгой генерации LLM
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistograms:
+    """Cumulative latency histograms per stage, plus LLM token counters."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts: dict[str, list[int]] = {}
+        self._sums: dict[str, float] = {}
+        self._tokens: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            # Последний элемент — бакет +Inf
+            counts = self._counts.setdefault(stage, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self._sums[stage] = self._sums.get(stage, 0.0) + seconds
+
+    def add_tokens(self, kind: str, count: int) -> None:
+        with self._lock:
+            self._tokens[kind] = self._tokens.get(kind, 0) + count
+
+    def quantile(self, stage: str, q: float) -> Optional[float]:
+        """Linear interpolation inside the bucket holding the q-th observation, as ``histogram_quantile``."""
+        with self._lock:
+            counts = list(self._counts.get(stage, ()))
+        if not counts or not counts[-1]:
+            return None
+        rank = q * counts[-1]
+        lower, below = 0.0, 0
+        for bound, count in zip(self.buckets, counts):
+            if count >= rank:
+                return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+            lower, below = bound, count
+        # Выше последней границы оценки нет — как и у Prometheus, это последняя граница
+        return self.buckets[-1]
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """{stage: {"p50": ms, "p95": ms, "p99": ms, "count": n}}."""
+        with self._lock:
+            stages = {stage: counts[-1] for stage, counts in self._counts.items()}
+        return {
+            stage: {
+                **{f"p{round(q * 100)}": round(self.quantile(stage, q) * 1000, 1) for q in QUANTILES},
+                "count": count,
+            }
+            for stage, count in stages.items()
+        }
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        with self._lock:
+            counts = {stage: list(values) for stage, values in self._counts.items()}
+            sums = dict(self._sums)
+            tokens = dict(self._tokens)
+        lines = [
+            "# HELP rag_stage_seconds Time spent in a stage of the RAG pipeline.",
+            "# TYPE rag_stage_seconds histogram",
+        ]
+        for stage, values in sorted(counts.items()):
+            for bound, count in zip(self.buckets, values):
+                lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {values[-1]}')
+            lines.append(f'rag_stage_seconds_sum{{stage="{stage}"}} {sums[stage]:.6f}')
+            lines.append(f'rag_stage_seconds_count{{stage="{stage}"}} {values[-1]}')
+        lines += [
+            "# HELP rag_stage_quantile_seconds Quantiles interpolated from rag_stage_seconds buckets.",
+            "# TYPE rag_stage_quantile_seconds gauge",
+        ]
+        for stage in sorted(counts):
+            for q in QUANTILES:
+                value = self.quantile(stage, q)
+                if value is not None:
+                    lines.append(f'rag_stage_quantile_seconds{{stage="{stage}",quantile="{q}"}} {value:.6f}')
+        lines += [
+            "# HELP rag_llm_tokens_total LLM tokens by kind (prompt, completion, context).",
+            "# TYPE rag_llm_tokens_total counter",
+        ]
+        for kind, count in sorted(tokens.items()):
+            lines.append(f'rag_llm_tokens_total{{kind="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+class QueryTrace:
+    """Stage durations, token counts and model names of one query."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans: dict[str, float] = {}
+        self.tokens: dict[str, int] = {}
+        self.models: dict[str, str] = {}
+        self.extra: dict = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            # Повторный этап (например, несколько вызовов LLM) суммируется
+            self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def add_usage(self, usage) -> None:
+        """Token counts from an OpenAI-compatible ``usage`` object."""
+        if usage is None:
+            return
+        for kind in ("prompt", "completion"):
+            count = getattr(usage, f"{kind}_tokens", None)
+            if count is not None:
+                self.tokens[kind] = count
+
+    def finish(self, histograms: Optional[LatencyHistograms] = None) -> dict:
+        """The trace for the query log; stage durations are added to ``histograms``."""
+        total = time.perf_counter() - self.started
+        with self._lock:
+            spans = dict(self.spans)
+        if histograms is not None:
+            for name, seconds in spans.items():
+                histograms.observe(name, seconds)
+            histograms.observe("total", total)
+            for kind, count in self.tokens.items():
+                histograms.add_tokens(kind, count)
+        trace = {
+            "total_ms": round(total * 1000, 1),
+            "spans_ms": {name: round(seconds * 1000, 1) for name, seconds in spans.items()},
+        }
+        if self.tokens:
+            trace["tokens"] = dict(self.tokens)
+        if self.models:
+            trace["models"] = dict(self.models)
+        trace.update(self.extra)
+        return trace
+
+
+async def traced_stream(stream, trace: QueryTrace, started: float, stage: str = "llm_first_token") -> AsyncIterator:
+    """Pass a ``stream=True`` completion through, recording time to first token, model and usage."""
+    first = True
+    async for chunk in stream:
+        if getattr(chunk, "model", None):
+            trace.models["llm"] = chunk.model
+        trace.add_usage(getattr(chunk, "usage", None))
+        if first and chunk.choices and chunk.choices[0].delta.content:
+            trace.record(stage, time.perf_counter() - started)
+            first = False
+        yield chunk
+
+
+def start_metrics_server(histograms: LatencyHistograms, port: int = METRICS_PORT, host: str = METRICS_HOST):
+    """Serve ``GET /metrics`` from a daemon thread; returns the server, or None when ``port`` is 0."""
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = histograms.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Метрики задержек: http://%s:%d/metrics", host, port)
+    return server